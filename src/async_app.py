@@ -0,0 +1,197 @@
+import os
+import json
+import asyncio
+import aiohttp
+
+from aiohttp import web
+
+import es_client
+import rerank
+from main import (DOCUMENT_SRC_FOLDER, JSON_HEADERS, SEARCH_PAGE_SIZE, STREAM_CHUNK_SIZE, UNAVAILABLE_BODY, log,
+                  parse_flag, parse_highlight, parse_search_query, build_search_payload, search_cache, search_cache_key,
+                  search_url, observe_took, finish_request_timing, check_index_generation, refresh_query_analyzer,
+                  remember_search, stale_cache)
+from metrics import StageTimer, render_metrics
+
+ASYNC_POOL_SIZE = int(os.environ.get("SUPERDOC_ASYNC_POOL_SIZE", 256))
+
+
+async def open_es_session(app):
+    # The event loop multiplexes every in-flight search over this one pool,
+    # so the number of concurrent searches is bounded by the pool and not by
+    # the number of worker threads.
+    connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(sock_connect=es_client.CONNECT_TIMEOUT, sock_read=es_client.READ_TIMEOUT)
+    app["es_session"] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def build_query_analyzer(app):
+    # Built before the first request, on a thread so the ES call and the
+    # file reads never block the event loop
+    await asyncio.get_running_loop().run_in_executor(None, refresh_query_analyzer)
+
+
+async def close_es_session(app):
+    await app["es_session"].close()
+
+
+async def add_cors_headers(req, response):
+    # Signal rather than middleware so streamed responses get the header
+    # before they are prepared
+    response.headers["Access-Control-Allow-Origin"] = "*"
+
+
+async def handle_options(req):
+    return web.Response()
+
+
+def json_response(body):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return web.Response(body=body, content_type="application/json")
+
+
+def stale_response(cache_key, reason):
+    stale = stale_cache.get(cache_key)
+    log.warning("stale_response(): elasticsearch unavailable (%s), %s", reason,
+                "serving the last good result" if stale is not None else "nothing to fall back to")
+    if stale is None:
+        return web.Response(text=UNAVAILABLE_BODY, status=503, content_type="application/json")
+    response = json_response(stale)
+    response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+async def send_search(req, url, payload, cache_key):
+    # Same circuit and deadline as the Flask app, only the transport differs.
+    # Returns the ES response, or instead the stale fallback when ES fails.
+    if not es_client.breaker.allow():
+        return None, stale_response(cache_key, "circuit open")
+
+    # A per-request timeout replaces the session's whole, connect included
+    connect_timeout, read_timeout = es_client.search_timeout()
+    try:
+        r = await req.app["es_session"].get(url, headers=JSON_HEADERS, data=payload,
+                                             timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout,
+                                                                           sock_read=read_timeout))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        es_client.record_outcome(False)
+        return None, stale_response(cache_key, e)
+    es_client.record_outcome(not es_client.is_unhealthy_status(r.status))
+    if es_client.is_unhealthy_status(r.status):
+        r.release()
+        return None, stale_response(cache_key, r.status)
+    return r, None
+
+
+def rerank_body(body, query, search_from):
+    result = rerank.rerank_result(json.loads(body), query, search_from, SEARCH_PAGE_SIZE, DOCUMENT_SRC_FOLDER)
+    return json.dumps(result)
+
+
+async def evaluate_reranked_query(req, url, cache_key, timer, parsed, compact, highlight):
+    # Same re-ranking as the Flask app, so a query is ordered the same
+    # whichever server answers it. The NumPy work runs off the event loop.
+    query_kind, query, search_from = parsed
+    payload = build_search_payload(query_kind, query, 0, compact, highlight, rerank.rerank_depth(SEARCH_PAGE_SIZE))
+    timer.mark("build")
+
+    r, fallback = await send_search(req, url, payload, cache_key)
+    if fallback is not None:
+        return fallback
+    async with r:
+        body = await r.read()
+    timer.mark("es")
+    observe_took(body, "search")
+    if r.status != 200:
+        return web.Response(body=body, status=r.status, content_type="application/json")
+
+    body = await asyncio.get_running_loop().run_in_executor(None, rerank_body, body, query, search_from)
+    timer.mark("rerank")
+    remember_search(cache_key, body)
+    timer.mark("serialize")
+    finish_request_timing(timer, "search", query_kind, query)
+    return json_response(body)
+
+
+async def evaluate_query(req):
+    timer = StageTimer()
+    check_index_generation()
+    parsed = parse_search_query(req.query.get('q'), req.query.get('from'))
+    if parsed is None:
+        return web.Response(status=400)
+
+    query_kind, query, search_from = parsed
+    compact = parse_flag(req.query.get('compact'))
+    highlight = parse_highlight(req.query.get('highlight'))
+    cache_key = search_cache_key(query_kind, query, search_from, compact, highlight)
+    timer.mark("parse")
+
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        timer.mark("cache")
+        finish_request_timing(timer, "search", query_kind, query)
+        return json_response(cached)
+
+    url = es_client.ES_URL + search_url(compact)
+    if rerank.reranks(query_kind, search_from, SEARCH_PAGE_SIZE, DOCUMENT_SRC_FOLDER):
+        return await evaluate_reranked_query(req, url, cache_key, timer, parsed, compact, highlight)
+
+    payload = build_search_payload(query_kind, query, search_from, compact, highlight)
+    timer.mark("build")
+
+    r, fallback = await send_search(req, url, payload, cache_key)
+    if fallback is not None:
+        return fallback
+
+    async with r:
+        log.debug("evaluate_query_async(): %d", r.status)
+        if not compact:
+            body = await r.text()
+            timer.mark("es")
+            observe_took(body, "search")
+            if r.status == 200:
+                remember_search(cache_key, body)
+            response = json_response(body)
+            timer.mark("serialize")
+            finish_request_timing(timer, "search", query_kind, query)
+            return response
+
+        timer.mark("es")
+
+        response = web.StreamResponse(status=r.status, headers={"Content-Type": "application/json"})
+        await response.prepare(req)
+        chunks = list()
+        async for chunk in r.content.iter_chunked(STREAM_CHUNK_SIZE):
+            chunks.append(chunk)
+            await response.write(chunk)
+        await response.write_eof()
+
+    if chunks:
+        observe_took(chunks[0], "search")
+    if r.status == 200:
+        remember_search(cache_key, b"".join(chunks))
+    timer.mark("serialize")
+    finish_request_timing(timer, "search", query_kind, query)
+    return response
+
+
+async def metrics(req):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+def create_app():
+    app = web.Application()
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(open_es_session)
+    app.on_startup.append(build_query_analyzer)
+    app.on_cleanup.append(close_es_session)
+    app.router.add_route("GET", "/search", evaluate_query)
+    app.router.add_route("POST", "/search", evaluate_query)
+    app.router.add_route("OPTIONS", "/search", handle_options)
+    app.router.add_route("GET", "/metrics", metrics)
+    return app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="localhost", port=4001)
@@ -0,0 +1,325 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import requests
+import es_client
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from contextlib import redirect_stdout
+from xml.sax.saxutils import quoteattr, escape
+from werkzeug.serving import make_server
+
+DEFAULT_MIX = "default=6,condition=2,symptom=2,document=2"
+DEFAULT_QUERIES = {
+    "default": ["diabetes", "flu", "covid", "high blood pressure", "asthma", "back pain", "depression"],
+    "condition": ["diabetes", "influenza", "hypertension", "migraine", "arthritis"],
+    "symptom": ["chest pain", "fever", "shortness of breath", "headache", "fatigue", "dizziness"],
+    "document": [str(i) for i in range(1, 51)]
+}
+
+
+def synthetic_topic(doc_id):
+    return {
+        "_index": es_client.INDEX_NAME,
+        "_id": str(doc_id),
+        "_score": 1.0,
+        "_source": {
+            "@title": "Topic " + str(doc_id),
+            "@url": "https://medlineplus.gov/topic" + str(doc_id) + ".html",
+            "@meta-desc": "Synthetic health topic used by the benchmark suite.",
+            "full-summary": "<p>" + "Lorem ipsum dolor sit amet. " * 40 + "</p>"
+        },
+        "highlight": {"@meta-desc": ["Synthetic <strong>health</strong> topic"]}
+    }
+
+
+def synthetic_recording():
+    return {
+        "_search": {
+            "took": 4,
+            "timed_out": False,
+            "hits": {
+                "total": {"value": 1000, "relation": "eq"},
+                "max_score": 1.0,
+                "hits": [synthetic_topic(i) for i in range(15)]
+            }
+        },
+        "_doc": dict(synthetic_topic(1), found=True)
+    }
+
+
+class FakeElasticsearch:
+    # Stand-in for a single ES node that answers every request with a
+    # recorded response, so the numbers measure this service and not the
+    # cluster. es_latency adds a fixed delay per call to model the network.
+
+    def __init__(self, recording=None, es_latency=0.0):
+        self.recording = recording or synthetic_recording()
+        self.es_latency = es_latency
+        self.server = ThreadingHTTPServer(("localhost", 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.url = "http://localhost:" + str(self.server.server_address[1])
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def read_body(self):
+                if self.headers.get("Transfer-Encoding") == "chunked":
+                    body = b""
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return body
+                        body += self.rfile.read(size)
+                        self.rfile.readline()
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def respond(self):
+                body = self.read_body()
+                if fake.es_latency:
+                    time.sleep(fake.es_latency)
+
+                path = self.path.split("?")[0]
+                if path.endswith("/_bulk"):
+                    lines = body.splitlines()
+                    items = [{"index": {"status": 201}} for line in lines if b'"index"' in line[:20]]
+                    response = {"took": 1, "errors": False, "items": items}
+                elif path.endswith("/_msearch"):
+                    response = {"responses": [dict(fake.recording["_search"], status=200)] * (len(body.splitlines()) // 2)}
+                elif path.endswith("/_search"):
+                    response = fake.recording["_search"]
+                elif "/_doc/" in path:
+                    response = fake.recording["_doc"]
+                elif path.endswith("/_settings") and self.command == "GET":
+                    response = {es_client.INDEX_NAME: {"settings": {}}}
+                else:
+                    response = {"acknowledged": True}
+
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = respond
+
+        return Handler
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def parse_mix(mix):
+    weights = dict()
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None
+    }
+
+
+def request_path(kind, query):
+    if kind == "document":
+        return "/document/" + query
+    if kind == "default":
+        return "/search?q=" + requests.utils.quote(query)
+    return "/search?q=" + requests.utils.quote(kind + ": " + query)
+
+
+def run_serving_benchmark(service_url, weights, queries, total, concurrency, seed):
+    rng = random.Random(seed)
+    kinds = list(weights)
+    plan = [rng.choices(kinds, [weights[kind] for kind in kinds])[0] for _ in range(total)]
+    plan = [(kind, rng.choice(queries[kind])) for kind in plan]
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+
+    def timed(item):
+        kind, query = item
+        start = time.perf_counter()
+        r = session.get(service_url + request_path(kind, query))
+        return kind, time.perf_counter() - start, r.status_code
+
+    results = list()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results.extend(executor.map(timed, plan))
+    elapsed = time.perf_counter() - start
+
+    report = {"overall": summarize([latency for _, latency, _ in results], elapsed)}
+    report["overall"]["errors"] = sum(1 for _, _, status in results if status >= 400)
+    for kind in kinds:
+        report[kind] = summarize([latency for k, latency, _ in results if k == kind], elapsed)
+    return report
+
+
+def write_synthetic_topics(path, count):
+    with open(path, "w") as dataset:
+        dataset.write('<?xml version="1.0" encoding="UTF-8"?>\n<health-topics total="' + str(count) + '">\n')
+        for i in range(count):
+            title = "Topic " + str(i)
+            dataset.write('<health-topic id="' + str(i) + '" title=' + quoteattr(title) +
+                          ' url="https://medlineplus.gov/topic' + str(i) + '.html" language="English"'
+                          ' date-created="01/01/2020" meta-desc="Synthetic topic.">'
+                          '<also-called>Alias ' + str(i) + '</also-called>'
+                          '<full-summary>' + escape("<p>" + "Lorem ipsum dolor sit amet. " * 60 + "</p>") +
+                          '</full-summary>'
+                          '<site title="Site" url="https://example.org/' + str(i) + '">'
+                          '<information-category>Learn More</information-category></site>'
+                          '</health-topic>\n')
+        dataset.write('</health-topics>\n')
+
+
+def run_ingest_benchmark(main, topics_path):
+    # Loaded into a throwaway index, never the live alias: the synthetic
+    # topics would overwrite real ones and the load flips index settings.
+    # The name stays clear of the alias prefix that delete_old_indices() prunes.
+    index_name = main.create_index("superdoc-benchmark-" + time.strftime("%Y%m%d%H%M%S"))
+    try:
+        start = time.perf_counter()
+        totals = main.index_bulk_data(main.generate_data(stream=True, path=topics_path), full_load=True,
+                                      index_name=index_name)
+        elapsed = time.perf_counter() - start
+    finally:
+        es_client.delete(es_client.index_path("", index_name))
+    docs = totals["indexed"] + totals["failed"]
+    return {
+        "docs": docs,
+        "failed": totals["failed"],
+        "seconds": round(elapsed, 3),
+        "docs_per_sec": round(docs / elapsed, 2) if elapsed else None
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024.0, 2)
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput and latency benchmark for the SuperDoc search service")
+    parser.add_argument("--es-url", help="benchmark against this Elasticsearch node instead of the recorded fake")
+    parser.add_argument("--recording", help="JSON file with recorded _search and _doc responses for the fake")
+    parser.add_argument("--es-latency-ms", type=float, default=0.0, help="delay added to every fake ES response")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="request mix as kind=weight pairs")
+    parser.add_argument("--queries", help="JSON file mapping each kind in the mix to a list of queries or doc ids")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--no-cache", action="store_true", help="disable the search result cache")
+    parser.add_argument("--ingest-docs", type=int, default=1000, help="synthetic topics to ingest, 0 to skip")
+    parser.add_argument("--topics", help="ingest this mplus_topics.xml instead of synthetic topics")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    fake = None
+    if args.es_url is None:
+        recording = None
+        if args.recording:
+            with open(args.recording) as recording_file:
+                recording = json.load(recording_file)
+        fake = FakeElasticsearch(recording, args.es_latency_ms / 1000.0).start()
+        # create_index() copies the stoplist into the node's config directory,
+        # the fake has none and the local node's must not be touched
+        os.environ["SUPERDOC_ES_CONFIG_DIR"] = tempfile.mkdtemp()
+    es_client.configure(url=args.es_url or fake.url)
+
+    import main
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    main.refresh_query_analyzer()
+    if args.no_cache:
+        main.search_cache.max_entries = 0
+
+    server = make_server("localhost", 0, main.app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    service_url = "http://localhost:" + str(server.server_port)
+
+    # The service logs to stdout, keep it off the machine-readable report
+    with redirect_stdout(sys.stderr):
+        report = run_benchmarks(args, main, service_url, fake)
+
+    server.shutdown()
+    if fake is not None:
+        fake.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+def run_benchmarks(args, main, service_url, fake):
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as queries_file:
+            queries = json.load(queries_file)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "es": "fake" if fake else args.es_url,
+            "mix": args.mix,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "cache": not args.no_cache
+        },
+        "serving": run_serving_benchmark(service_url, parse_mix(args.mix), queries, args.requests,
+                                         args.concurrency, args.seed)
+    }
+
+    if args.topics or args.ingest_docs > 0:
+        topics_path = args.topics
+        if topics_path is None:
+            topics_path = os.path.join(tempfile.mkdtemp(), "mplus_topics.xml")
+            write_synthetic_topics(topics_path, args.ingest_docs)
+        report["ingest"] = run_ingest_benchmark(main, topics_path)
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+if __name__ == "__main__":
+    main_benchmark()
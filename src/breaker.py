@@ -0,0 +1,49 @@
+import time
+
+from threading import Lock
+
+
+class CircuitBreaker:
+    # Closed: every call goes through and consecutive failures are counted.
+    # Open: calls are refused until reset_after seconds have passed. Then a
+    # single trial call is let through, and its outcome closes the circuit
+    # or opens it for another period.
+
+    def __init__(self, failure_threshold=5, reset_after=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        # True when this failure is the one that opened the circuit
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            was_closed = self.opened_at is None
+            if not was_closed or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            return was_closed and self.opened_at is not None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.trial_running else "open"
@@ -0,0 +1,122 @@
+import os
+import logging
+import requests
+
+from requests.adapters import HTTPAdapter
+from breaker import CircuitBreaker
+
+ES_URL = os.environ.get("SUPERDOC_ES_URL", "http://localhost:9200")
+INDEX_NAME = os.environ.get("SUPERDOC_INDEX", "mayoc-index")
+POOL_SIZE = int(os.environ.get("SUPERDOC_ES_POOL_SIZE", 32))
+CONNECT_TIMEOUT = float(os.environ.get("SUPERDOC_ES_CONNECT_TIMEOUT", 2))
+READ_TIMEOUT = float(os.environ.get("SUPERDOC_ES_READ_TIMEOUT", 10))
+BULK_READ_TIMEOUT = float(os.environ.get("SUPERDOC_ES_BULK_READ_TIMEOUT", 120))
+# Budget for one search. ES gets it as its own timeout and returns what it
+# has found by then, the HTTP read only gives up a little later.
+SEARCH_DEADLINE_MS = int(os.environ.get("SUPERDOC_SEARCH_DEADLINE_MS", 2000))
+DEADLINE_GRACE = 0.5
+BREAKER_FAILURES = int(os.environ.get("SUPERDOC_BREAKER_FAILURES", 5))
+BREAKER_RESET = float(os.environ.get("SUPERDOC_BREAKER_RESET", 10))
+
+log = logging.getLogger("superdoc")
+session = None
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+def configure(url=None, index=None, pool_size=None, connect_timeout=None, read_timeout=None):
+    # One keep-alive session is shared by every handler and worker thread.
+    # pool_block makes threads wait for a free connection instead of opening
+    # throwaway ones once the pool is exhausted.
+    global ES_URL, INDEX_NAME, POOL_SIZE, CONNECT_TIMEOUT, READ_TIMEOUT, session
+
+    ES_URL = (url or ES_URL).rstrip("/")
+    INDEX_NAME = index or INDEX_NAME
+    POOL_SIZE = pool_size or POOL_SIZE
+    CONNECT_TIMEOUT = connect_timeout or CONNECT_TIMEOUT
+    READ_TIMEOUT = read_timeout or READ_TIMEOUT
+
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, pool_block=True)
+    new_session.mount("http://", adapter)
+    new_session.mount("https://", adapter)
+
+    if session is not None:
+        session.close()
+    session = new_session
+
+
+def index_path(suffix="", index=None):
+    return "/" + (index or INDEX_NAME) + suffix
+
+
+def bulk_timeout():
+    return CONNECT_TIMEOUT, BULK_READ_TIMEOUT
+
+
+def search_timeout():
+    return CONNECT_TIMEOUT, SEARCH_DEADLINE_MS / 1000.0 + DEADLINE_GRACE
+
+
+def deadline_param():
+    return "timeout=" + str(SEARCH_DEADLINE_MS) + "ms"
+
+
+def is_unhealthy_status(status):
+    return status == 429 or status >= 500
+
+
+def record_outcome(healthy):
+    if healthy:
+        breaker.record_success()
+    elif breaker.record_failure():
+        log.warning("circuit opened after %d failed requests, failing fast for %.0f s", breaker.failures,
+                    breaker.reset_after)
+
+
+def request(method, path, timeout=None, guarded=True, **kwargs):
+    # Refused outright while the circuit is open, so a struggling cluster
+    # is not buried under requests that would only time out. Index loads
+    # pass guarded=False: they retry 429s and 5xx themselves, and that
+    # backpressure must neither open the circuit searches go through nor
+    # be cut short by it.
+    if guarded and not breaker.allow():
+        raise CircuitOpenError("Elasticsearch circuit is open")
+
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    try:
+        r = session.request(method, ES_URL + path, timeout=timeout, **kwargs)
+    except requests.RequestException:
+        if guarded:
+            record_outcome(False)
+        raise
+    if guarded:
+        record_outcome(not is_unhealthy_status(r.status_code))
+    return r
+
+
+def get(path, **kwargs):
+    return request("GET", path, **kwargs)
+
+
+def post(path, **kwargs):
+    return request("POST", path, **kwargs)
+
+
+def put(path, **kwargs):
+    return request("PUT", path, **kwargs)
+
+
+def delete(path, **kwargs):
+    return request("DELETE", path, **kwargs)
+
+
+def head(path, **kwargs):
+    return request("HEAD", path, **kwargs)
+
+
+configure()
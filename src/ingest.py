@@ -0,0 +1,119 @@
+import os
+import argparse
+import es_client
+import rerank
+
+CHECKPOINT_KEYS = ("mode", "source", "chunk_docs", "chunk_bytes")
+
+
+def source_fingerprint(path):
+    # Size and modification time are enough to tell a new dump from the one
+    # an interrupted load was reading, without hashing the whole file again
+    stat = os.stat(path)
+    return str(stat.st_size) + "-" + str(stat.st_mtime_ns)
+
+
+def can_resume(main, checkpoint, expected):
+    if any(checkpoint.get(key) != expected[key] for key in CHECKPOINT_KEYS):
+        return False
+    # A rebuild can only continue in the index it was loading
+    if checkpoint["mode"] == "rebuild" and checkpoint.get("index"):
+        return main.index_exists(checkpoint["index"])
+    return True
+
+
+def dry_run(main, mode):
+    # Chunks exactly like a real load would, but only counts
+    manifest = dict() if mode == "rebuild" else main.load_manifest() or dict()
+    payload = main.generate_delta_data(manifest, dict())
+
+    report = {"chunks": 0, "docs": 0, "deletes": 0, "bytes": 0}
+    for chunk in main.iter_bulk_chunks(main.iter_bulk_entries(payload)):
+        report["chunks"] += 1
+        for entry in chunk:
+            report["deletes" if entry.startswith(b'{"delete"') else "docs"] += 1
+            report["bytes"] += len(entry)
+
+    print("dry_run(): mode=" + mode + " " + " ".join(key + "=" + str(value) for key, value in report.items()))
+    return report
+
+
+def ingest(rebuild=False, restart=False):
+    import main
+
+    expected = {
+        "source": source_fingerprint(os.path.join(main.DOCUMENT_SRC_FOLDER, "mplus_topics.xml")),
+        "chunk_docs": main.BULK_CHUNK_DOCS,
+        "chunk_bytes": main.BULK_CHUNK_BYTES
+    }
+
+    checkpoint = main.load_checkpoint()
+    if checkpoint is not None:
+        expected["mode"] = "rebuild" if rebuild else checkpoint.get("mode")
+        if restart or not can_resume(main, checkpoint, expected):
+            print("ingest(): discarding checkpoint of an earlier load")
+            main.clear_checkpoint()
+            checkpoint = None
+
+    if checkpoint is None:
+        rebuild = rebuild or not (main.index_exists() and main.load_manifest() is not None)
+        expected["mode"] = "rebuild" if rebuild else "delta"
+        checkpoint = dict(expected, acknowledged=0)
+        main.save_checkpoint(checkpoint)
+    else:
+        print("ingest(): resuming " + checkpoint["mode"] + " after chunk " + str(checkpoint["acknowledged"]))
+
+    if checkpoint["mode"] == "rebuild":
+        succeeded = main.rebuild_index(checkpoint) is not None
+    else:
+        main.update_synonyms()
+        succeeded = main.index_delta_data(checkpoint=checkpoint)["failed"] == 0
+
+    # A failed load keeps its checkpoint, the next run retries from the
+    # first chunk that was not acknowledged
+    if succeeded:
+        main.clear_checkpoint()
+        # Re-ranking vectors cover every topic, not only the ones a delta sent
+        if rerank.available():
+            rerank.write_embeddings(main.generate_actions(), main.DOCUMENT_SRC_FOLDER)
+    return succeeded
+
+
+def main_ingest(argv=None):
+    parser = argparse.ArgumentParser(prog="superdoc-ingest",
+                                     description="Load the MedlinePlus health topics into Elasticsearch")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="build a new index and swap the alias, instead of sending only changed topics")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an interrupted load")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be sent without touching the index")
+    parser.add_argument("--es-url", help="Elasticsearch URL, defaults to SUPERDOC_ES_URL")
+    parser.add_argument("--index", help="alias to load, defaults to SUPERDOC_INDEX")
+    parser.add_argument("--documents", help="folder with mplus_topics.xml, synonyms.csv and stoplist.txt")
+    parser.add_argument("--chunk-docs", type=int, help="documents per bulk request")
+    parser.add_argument("--chunk-bytes", type=int, help="bytes per bulk request")
+    parser.add_argument("--workers", type=int, help="concurrent bulk requests")
+    args = parser.parse_args(argv)
+
+    es_client.configure(url=args.es_url, index=args.index)
+    if args.documents:
+        os.environ["SUPERDOC_DOCUMENTS"] = args.documents
+    if args.chunk_docs:
+        os.environ["SUPERDOC_BULK_CHUNK_DOCS"] = str(args.chunk_docs)
+    if args.chunk_bytes:
+        os.environ["SUPERDOC_BULK_CHUNK_BYTES"] = str(args.chunk_bytes)
+    if args.workers:
+        os.environ["SUPERDOC_BULK_WORKERS"] = str(args.workers)
+
+    if args.dry_run:
+        import main
+        # Only the manifest decides the mode here, so a dry run needs no cluster
+        rebuild = args.rebuild or main.load_manifest() is None
+        dry_run(main, "rebuild" if rebuild else "delta")
+        return
+
+    if not ingest(args.rebuild, args.restart):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main_ingest()
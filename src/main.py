@@ -1,74 +1,356 @@
 import os
+import re
 import json
+import base64
+import binascii
+import hashlib
 import xmltodict
 import requests
-import csv
+import time
+import logging
+import xml.etree.ElementTree as ElementTree
+import es_client
+import rerank
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_cors import CORS, cross_origin
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+from functools import partial
+from cache import LRUCache
+from synonyms import compile_synonyms, read_terms
+from msearch import MultiSearchBatcher
+from metrics import Histogram, StageTimer, render_metrics
+from query_analysis import QueryAnalyzer
+from topics import HealthTopic
+from search_profiles import (COMPACT_FILTER_PATH, CURSOR_FILTER_PATH, CURSOR_KEEP_ALIVE, HIGHLIGHT_MAX_ANALYZED_OFFSET,
+                             SEARCH_PAGE_SIZE, SUGGEST_FILTER_PATH, render_cursor_payload, render_search_payload,
+                             render_suggest_payload)
 
 app = Flask(__name__)
 CORS(app)
-DOCUMENT_SRC_FOLDER = './documents'
+log = logging.getLogger("superdoc")
+DOCUMENT_SRC_FOLDER = os.environ.get("SUPERDOC_DOCUMENTS", "./documents")
+MANIFEST_FILE = "index_manifest.json"
+CHECKPOINT_FILE = "ingest_checkpoint.json"
+# Rewritten by every load, alias swap and synonym reload. Ingest runs in its
+# own process, the servers watch this file to know their caches are stale.
+GENERATION_FILE = "index_generation.json"
+GENERATION_CHECK_INTERVAL = float(os.environ.get("SUPERDOC_GENERATION_CHECK_INTERVAL", 1))
+# Synonym and stop files must sit in the config directory of the ES node,
+# ES_PATH_CONF is where Elasticsearch itself looks for it
+ES_CONFIG_DIR = os.environ.get("SUPERDOC_ES_CONFIG_DIR", os.environ.get("ES_PATH_CONF", "/etc/elasticsearch"))
+JSON_HEADERS = {"Content-Type": "application/json"}
+NDJSON_HEADERS = {"Content-Type": "application/x-ndjson"}
 
+BULK_CHUNK_DOCS = int(os.environ.get("SUPERDOC_BULK_CHUNK_DOCS", 500))
+BULK_CHUNK_BYTES = int(os.environ.get("SUPERDOC_BULK_CHUNK_BYTES", 5 * 1024 * 1024))
+BULK_WORKERS = int(os.environ.get("SUPERDOC_BULK_WORKERS", 4))
+BULK_MAX_RETRIES = 5
+BULK_RETRY_BACKOFF = 0.5
 
-def generate_data():
-    json_data = ""
-    with open(os.path.join(DOCUMENT_SRC_FOLDER, 'mplus_topics.xml')) as dataset:
-        dataset_dict = xmltodict.parse(dataset.read())
+SEARCH_CACHE_SIZE = int(os.environ.get("SUPERDOC_SEARCH_CACHE_SIZE", 2048))
+SEARCH_CACHE_TTL = float(os.environ.get("SUPERDOC_SEARCH_CACHE_TTL", 300))
+BOOLEAN_OPERATORS = {"AND", "OR", "NOT"}
+WARM_UP_QUERIES = ["diabetes", "flu", "covid"]
+INDEX_VERSIONS_KEPT = int(os.environ.get("SUPERDOC_INDEX_VERSIONS_KEPT", 2))
+STREAM_CHUNK_SIZE = 16 * 1024
+MSEARCH_WINDOW_MS = float(os.environ.get("SUPERDOC_MSEARCH_WINDOW_MS", 5))
+MSEARCH_MAX_BATCH = int(os.environ.get("SUPERDOC_MSEARCH_MAX_BATCH", 64))
+COALESCE_SEARCHES = os.environ.get("SUPERDOC_COALESCE_SEARCHES", "false").lower() in ("1", "true", "yes")
+DOCUMENT_CACHE_SIZE = int(os.environ.get("SUPERDOC_DOCUMENT_CACHE_SIZE", 4096))
+DOCUMENT_CACHE_BYTES = int(os.environ.get("SUPERDOC_DOCUMENT_CACHE_BYTES", 64 * 1024 * 1024))
+DOCUMENT_CACHE_TTL = float(os.environ.get("SUPERDOC_DOCUMENT_CACHE_TTL", 3600))
+DOCUMENTS_MAX_IDS = 100
+QUERY_ANALYSIS = os.environ.get("SUPERDOC_QUERY_ANALYSIS", "true").lower() in ("1", "true", "yes")
+KNOWN_PHRASE_FIELDS = ["@title.keyword", "also-called.keyword", "see-reference.keyword"]
+# How soon an analyzer built without the indexed titles tries to fetch them again
+KNOWN_PHRASES_RETRY = float(os.environ.get("SUPERDOC_KNOWN_PHRASES_RETRY", 30))
+SLOW_QUERY_MS = float(os.environ.get("SUPERDOC_SLOW_QUERY_MS", 500))
+TOOK_PATTERN = re.compile(rb'"took"\s*:\s*(\d+)')
+TIMED_OUT_PATTERN = re.compile(rb'"timed_out"\s*:\s*true')
+STALE_CACHE_SIZE = int(os.environ.get("SUPERDOC_STALE_CACHE_SIZE", 16384))
+STALE_CACHE_BYTES = int(os.environ.get("SUPERDOC_STALE_CACHE_BYTES", 128 * 1024 * 1024))
+STALE_CACHE_TTL = float(os.environ.get("SUPERDOC_STALE_CACHE_TTL", 24 * 3600))
+UNAVAILABLE_BODY = '{"error": "search unavailable"}'
 
-        for element_dict in dataset_dict["health-topics"]["health-topic"]:
-            doc_id = element_dict["@id"]
-            index_string = '{"index": {"_id": "' + doc_id + '"}}'
+REQUEST_STAGE_SECONDS = Histogram("superdoc_request_stage_seconds",
+                                  "Time spent in each stage of a request, and in total",
+                                  ["endpoint", "stage"])
+ES_TOOK_SECONDS = Histogram("superdoc_es_took_seconds", "Query time reported by Elasticsearch (took)", ["endpoint"])
 
-            doc = dict(element_dict)
-            doc.pop("@id")
-            json_data += index_string + "\n" + json.dumps(doc) + "\n"
+search_cache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+suggest_cache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+document_cache = LRUCache(DOCUMENT_CACHE_SIZE, DOCUMENT_CACHE_TTL, DOCUMENT_CACHE_BYTES)
+# Last good search results and documents, kept much longer than the caches
+# above and only read while ES is failing. clear_caches() leaves it alone,
+# an older answer still beats an error during an outage.
+stale_cache = LRUCache(STALE_CACHE_SIZE, STALE_CACHE_TTL, STALE_CACHE_BYTES)
+
+
+def clear_caches():
+    search_cache.clear()
+    suggest_cache.clear()
+    document_cache.clear()
+    # Titles may have changed with the index, the analyzer reloads them in
+    # the background and the current one keeps serving until then
+    query_analyzer["stale"] = True
+
+
+def index_changed():
+    # Clears the caches of this process and tells the serving processes to
+    # clear theirs
+    clear_caches()
+    save_state(GENERATION_FILE, {"changed_at": time.time()})
+
+
+index_generation = {"checked_at": None, "mtime": None}
+
+
+def check_index_generation():
+    # At most one stat per interval on the request path. The first check
+    # only records the generation, the caches start out empty anyway.
+    now = time.monotonic()
+    checked_at = index_generation["checked_at"]
+    if checked_at is not None and now - checked_at < GENERATION_CHECK_INTERVAL:
+        return
+    index_generation["checked_at"] = now
+
+    try:
+        mtime = os.stat(os.path.join(DOCUMENT_SRC_FOLDER, GENERATION_FILE)).st_mtime_ns
+    except OSError:
+        mtime = None
+    changed = checked_at is not None and mtime != index_generation["mtime"]
+    index_generation["mtime"] = mtime
+    if changed:
+        log.info("check_index_generation(): index changed, clearing caches")
+        clear_caches()
+
+
+def iter_health_topics(path=None):
+    # Streams the MedlinePlus dump one <health-topic> at a time instead of
+    # building the whole dict tree, so memory stays flat regardless of the
+    # size of the file. Each topic is still converted with xmltodict, so the
+    # yielded dicts look exactly like the ones xmltodict.parse() produced.
+    if path is None:
+        path = os.path.join(DOCUMENT_SRC_FOLDER, 'mplus_topics.xml')
+
+    depth = 0
+    root = None
+    for event, element in ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1 and element.tag == "health-topic":
+            yield xmltodict.parse(ElementTree.tostring(element, encoding="unicode"))["health-topic"]
+            # Drop the finished topic so the tree never grows past one element
+            root.clear()
+
+
+def generate_actions(path=None):
+    for element_dict in iter_health_topics(path):
+        topic = HealthTopic(element_dict)
+        yield topic.id, topic
+
+
+def generate_data(stream=False, path=None):
+    lines = (
+        '{"index": {"_id": "' + doc_id + '"}}\n' + topic.to_json() + "\n"
+        for doc_id, topic in generate_actions(path)
+    )
+
+    if stream:
+        return lines
 
     # with open(os.path.join(DOCUMENT_SRC_FOLDER, "data.json"), "w") as document:
     #     document.write(json_data)
 
-    return json_data
+    return "".join(lines)
+
+
+def fingerprint(serialized_doc):
+    return hashlib.sha1(serialized_doc.encode("utf-8")).hexdigest()
+
+
+def load_state(file_name):
+    path = os.path.join(DOCUMENT_SRC_FOLDER, file_name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as state_file:
+        return json.load(state_file)
+
+
+def save_state(file_name, state):
+    # Written next to the target and renamed over it, so an interrupted
+    # write never leaves a truncated file behind
+    path = os.path.join(DOCUMENT_SRC_FOLDER, file_name)
+    with open(path + ".tmp", "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(path + ".tmp", path)
+
+
+def load_manifest():
+    return load_state(MANIFEST_FILE)
+
+
+def save_manifest(manifest):
+    save_state(MANIFEST_FILE, manifest)
+
+
+def load_checkpoint():
+    return load_state(CHECKPOINT_FILE)
+
+
+def save_checkpoint(checkpoint):
+    save_state(CHECKPOINT_FILE, checkpoint)
+
+
+def clear_checkpoint():
+    path = os.path.join(DOCUMENT_SRC_FOLDER, CHECKPOINT_FILE)
+    if os.path.exists(path):
+        os.remove(path)
 
 
-def nGrams(query):
-    grams = list()
-    words = query.lower().split()
-    n = len(words)
+def generate_delta_data(manifest, new_manifest):
+    # Only topics whose content hash differs from the manifest are sent, and
+    # IDs that are no longer in the dump are deleted once the dump has been
+    # read. new_manifest is filled in as the generator is consumed.
+    changed = 0
+    for doc_id, topic in generate_actions():
+        serialized_doc = topic.to_json()
+        digest = fingerprint(serialized_doc)
+        new_manifest[doc_id] = digest
 
-    for k in range(n, 0, -1):
-        for i in range(n - k + 1):
-            grams.append(' '.join(words[i:i + k]))
-    return grams
+        if manifest.get(doc_id) != digest:
+            changed += 1
+            yield '{"index": {"_id": ' + json.dumps(doc_id) + '}}\n' + serialized_doc + "\n"
+
+    removed = manifest.keys() - new_manifest.keys()
+    for doc_id in removed:
+        yield '{"delete": {"_id": ' + json.dumps(doc_id) + '}}\n'
+
+    print("generate_delta_data(): changed=" + str(changed) + " removed=" + str(len(removed)))
 
 
 def read_synonyms():
-    synonyms = dict()
+    # Compiles straight into the ES config directory, and only when the CSV
+    # has changed since the last compile
+    changed = compile_synonyms(os.path.join(DOCUMENT_SRC_FOLDER, "synonyms.csv"),
+                               os.path.join(ES_CONFIG_DIR, "solr_synonyms.txt"))
+    print("read_synonyms(): " + ("compiled" if changed else "unchanged"))
+    return changed
+
 
-    with open(os.path.join(DOCUMENT_SRC_FOLDER, "synonyms.csv")) as syn_file:
-        for row in csv.reader(syn_file):
-            synonyms.setdefault(row[0], list())
-            synonyms[row[0]].append(row[1])
+def load_synonym_terms():
+    # Read again on every analyzer build, which also picks up an edited CSV
+    return read_terms(os.path.join(DOCUMENT_SRC_FOLDER, "synonyms.csv"))
 
-    with open(os.path.join(DOCUMENT_SRC_FOLDER, "solr_synonyms.txt"), "w") as solr_syn_file:
-        for row in synonyms.values():
-            solr_string = ""
-            for word in row:
-                solr_string += word + ", "
-            solr_syn_file.write(solr_string[:-2] + "\n")
 
+def read_stoplist():
+    with open(os.path.join(DOCUMENT_SRC_FOLDER, "stoplist.txt")) as stoplist:
+        return [line.strip() for line in stoplist if line.strip()]
 
-def create_index():
-    copyfile(os.path.join(DOCUMENT_SRC_FOLDER, "stoplist.txt"),
-             "/Users/mo/Desktop/elasticsearch-7.11.1/config/stoplist.txt")
-    copyfile(os.path.join(DOCUMENT_SRC_FOLDER, "solr_synonyms.txt"),
-             "/Users/mo/Desktop/elasticsearch-7.11.1/config/solr_synonyms.txt")
 
-    url = "http://localhost:9200/mayoc-index?pretty"
+def fetch_known_phrases():
+    # Titles and alternative names of every indexed topic, None when the
+    # index cannot be reached
+    payload = {
+        "size": 0,
+        "aggs": {field: {"terms": {"field": field, "size": 10000}} for field in KNOWN_PHRASE_FIELDS}
+    }
+    try:
+        r = es_client.get(es_client.index_path("/_search"), json=payload)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+
+    aggregations = r.json().get("aggregations", dict())
+    return [bucket["key"] for aggregation in aggregations.values() for bucket in aggregation.get("buckets", [])]
+
+
+query_analyzer = {"analyzer": None, "complete": False, "stale": True, "built_at": None}
+query_analyzer_lock = Lock()
+
+
+def build_query_analyzer():
+    # Called with query_analyzer_lock held. The stale flag is cleared first,
+    # so a reindex that lands during the build asks for another one.
+    query_analyzer["stale"] = False
+    try:
+        stopwords = read_stoplist()
+        synonym_terms = list(load_synonym_terms())
+    except OSError as e:
+        # Without the local files searches go out unanalyzed, as typed
+        log.warning("build_query_analyzer(): query analysis disabled, %s", e)
+        query_analyzer.update(analyzer=None, complete=True, built_at=time.monotonic())
+        return
+
+    # Without a reachable index the analyzer works from the synonyms alone
+    # until a later refresh gets the titles
+    phrases = fetch_known_phrases()
+    query_analyzer.update(analyzer=QueryAnalyzer(stopwords, synonym_terms + (phrases or [])),
+                          complete=phrases is not None, built_at=time.monotonic())
+
+
+def refresh_query_analyzer():
+    # Eager build at app start, before the first request can need it
+    with query_analyzer_lock:
+        build_query_analyzer()
+    return query_analyzer["analyzer"]
+
+
+def refresh_query_analyzer_in_background():
+    try:
+        build_query_analyzer()
+    finally:
+        query_analyzer_lock.release()
+
+
+def get_query_analyzer():
+    # Never builds on the request path: it returns the current analyzer, or
+    # None before the first build, and hands a due rebuild to one background
+    # thread, the lock keeps concurrent requests from starting more
+    built_at = query_analyzer["built_at"]
+    due = query_analyzer["stale"] or (not query_analyzer["complete"] and built_at is not None and
+                                      time.monotonic() - built_at >= KNOWN_PHRASES_RETRY)
+    if due and query_analyzer_lock.acquire(blocking=False):
+        Thread(target=refresh_query_analyzer_in_background, daemon=True).start()
+    return query_analyzer["analyzer"]
+
+
+def reload_synonyms():
+    # The synonym_graph filter is updateable, so the live index picks up a
+    # recompiled file without being closed or rebuilt
+    r = es_client.post(es_client.index_path("/_reload_search_analyzers"))
+    index_changed()
+    print("reload_synonyms(): " + str(r.status_code))
+
+
+def update_synonyms():
+    if read_synonyms() and index_exists():
+        reload_synonyms()
+
+
+def versioned_index_name():
+    return es_client.INDEX_NAME + "-" + time.strftime("%Y%m%d%H%M%S")
+
+
+def create_index(index_name=None):
+    copyfile(os.path.join(DOCUMENT_SRC_FOLDER, "stoplist.txt"), os.path.join(ES_CONFIG_DIR, "stoplist.txt"))
+
+    index_name = index_name or versioned_index_name()
+    url = es_client.index_path("?pretty", index_name)
     payload = {
         "settings": {
             "index.mapping.ignore_malformed": "true",
+            "index.highlight.max_analyzed_offset": HIGHLIGHT_MAX_ANALYZED_OFFSET,
             "analysis": {
                 "analyzer": {
                     "custom_analyzer": {
@@ -108,6 +390,7 @@ def create_index():
                     "synonym_graph": {
                         "type": "synonym_graph",
                         "expand": "true",
+                        "updateable": "true",
                         "synonyms_path": "./solr_synonyms.txt"
                         # "synonyms": ["ball, testicular"]
                     },
@@ -136,6 +419,7 @@ def create_index():
                 "@meta-desc": {
                     "type": "text",
                     "index_phrases": "true",
+                    "index_options": "offsets",
                     "analyzer": "custom_analyzer",
                     "search_analyzer": "custom_search_stop_analyzer",
                     "search_quote_analyzer": "custom_search_analyzer",
@@ -179,6 +463,7 @@ def create_index():
                 "full-summary": {
                     "type": "text",
                     "index_phrases": "true",
+                    "index_options": "offsets",
                     "analyzer": "custom_analyzer",
                     "search_analyzer": "custom_search_stop_analyzer",
                     "search_quote_analyzer": "custom_search_analyzer",
@@ -190,174 +475,63 @@ def create_index():
                     }
                 },
                 "group": {
-                    "properties": {
-                        "#text": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "@id": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@url": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
+                    "type": "text",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
                 },
                 "language-mapped-topic": {
-                    "properties": {
-                        "#text": {
-                            "type": "text",
-                            "index_phrases": "true",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "@id": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@language": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "@url": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
+                    "type": "text",
+                    "index_phrases": "true",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
                 },
                 "mesh-heading": {
-                    "properties": {
-                        "descriptor": {
-                            "properties": {
-                                "#text": {
-                                    "type": "text",
-                                    "analyzer": "custom_analyzer",
-                                    "search_analyzer": "custom_search_stop_analyzer",
-                                    "search_quote_analyzer": "custom_search_analyzer",
-                                    "fields": {
-                                        "keyword": {
-                                            "type": "keyword"
-                                        }
-                                    }
-                                },
-                                "@id": {
-                                    "type": "text",
-                                    "index": "false"
-                                }
-                            }
-                        },
-                        "qualifier": {
-                            "properties": {
-                                "#text": {
-                                    "type": "text",
-                                    "analyzer": "custom_analyzer",
-                                    "search_analyzer": "custom_search_stop_analyzer",
-                                    "search_quote_analyzer": "custom_search_analyzer",
-                                    "fields": {
-                                        "keyword": {
-                                            "type": "keyword"
-                                        }
-                                    }
-                                },
-                                "@id": {
-                                    "type": "text",
-                                    "index": "false"
-                                }
-                            }
+                    "type": "text",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
                 },
                 "other-language": {
-                    "properties": {
-                        "#text": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@url": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@vernacular-name": {
-                            "type": "text",
-                            "index": "false"
-                        }
-                    }
+                    "type": "object",
+                    "enabled": "false"
                 },
                 "primary-institute": {
-                    "properties": {
-                        "#text": {
-                            "type": "text",
-                            "index_phrases": "true",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "@url": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
+                    "type": "text",
+                    "index_phrases": "true",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
                 },
                 "related-topic": {
-                    "properties": {
-                        "#text": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "@id": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@url": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
+                    "type": "text",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
                 },
@@ -373,67 +547,317 @@ def create_index():
                     }
                 },
                 "site": {
-                    "properties": {
-                        "@language-mapped-url": {
-                            "type": "text",
-                            "index": "false"
-                        },
-                        "@title": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer"
-                        },
-                        "@url": {
-                            "type": "text",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "information-category": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer"
-                        },
-                        "organization": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer",
-                            "fields": {
-                                "keyword": {
-                                    "type": "keyword"
-                                }
-                            }
-                        },
-                        "standard-description": {
-                            "type": "text",
-                            "analyzer": "custom_analyzer",
-                            "search_analyzer": "custom_search_stop_analyzer",
-                            "search_quote_analyzer": "custom_search_analyzer"
+                    "type": "object",
+                    "enabled": "false"
+                },
+                "site-category": {
+                    "type": "text",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
+                        }
+                    }
+                },
+                "site-title": {
+                    "type": "text",
+                    "analyzer": "custom_analyzer",
+                    "search_analyzer": "custom_search_stop_analyzer",
+                    "search_quote_analyzer": "custom_search_analyzer",
+                    "fields": {
+                        "keyword": {
+                            "type": "keyword"
                         }
                     }
+                },
+                "suggest": {
+                    "type": "completion",
+                    "analyzer": "custom_analyzer",
+                    "preserve_separators": "false"
                 }
             }
         }
     }
 
-    requests.delete(url)
-    r = requests.put(url, json=payload)
+    r = es_client.put(url, json=payload, guarded=False)
     print("create_index(): " + str(r.status_code))
     print(r.text)
+    # Loading on regardless would let ES create the index on the first bulk
+    # request, with dynamic mappings, and alias it
+    r.raise_for_status()
+    return index_name
 
 
-def index_bulk_data(json_payload):
-    url = "http://localhost:9200/mayoc-index/_bulk?pretty&refresh"
-    headers = {"Content-Type": "application/json"}
+def iter_bulk_lines(json_payload):
+    if isinstance(json_payload, (str, bytes)):
+        json_payload = [json_payload]
 
-    r = requests.post(url, headers=headers, data=json_payload)
-    print("index_bulk_data(): " + str(r.status_code))
-    print(r.text)
+    for part in json_payload:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        for line in part.splitlines():
+            if line.strip():
+                yield line
+
+
+def iter_bulk_entries(json_payload):
+    # An entry is one action line plus its source line, except for deletes
+    # which have no source. Entries are never split across chunks.
+    lines = iter_bulk_lines(json_payload)
+    for action_line in lines:
+        entry = action_line + b"\n"
+        if "delete" not in json.loads(action_line):
+            entry += next(lines) + b"\n"
+        yield entry
+
+
+def iter_bulk_chunks(entries, max_docs=None, max_bytes=None):
+    max_docs = max_docs or BULK_CHUNK_DOCS
+    max_bytes = max_bytes or BULK_CHUNK_BYTES
+
+    chunk = list()
+    chunk_bytes = 0
+    for entry in entries:
+        if chunk and (len(chunk) >= max_docs or chunk_bytes + len(entry) > max_bytes):
+            yield chunk
+            chunk = list()
+            chunk_bytes = 0
+        chunk.append(entry)
+        chunk_bytes += len(entry)
+
+    if chunk:
+        yield chunk
+
+
+def is_retryable_status(status):
+    return status == 429 or status >= 500
+
+
+def send_bulk_chunk(entries, index_name=None):
+    url = es_client.index_path("/_bulk", index_name)
+
+    indexed = 0
+    failed = 0
+    for attempt in range(BULK_MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(BULK_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+        try:
+            r = es_client.post(url, headers=NDJSON_HEADERS, data=b"".join(entries), timeout=es_client.bulk_timeout(),
+                               guarded=False)
+        except requests.RequestException as e:
+            print("send_bulk_chunk(): " + str(e))
+            continue
+
+        if is_retryable_status(r.status_code):
+            continue
+        if r.status_code >= 400:
+            print("send_bulk_chunk(): " + str(r.status_code) + " " + r.text[:500])
+            return indexed, failed + len(entries)
+
+        # Only the items rejected with 429/5xx are sent again, everything
+        # else has either succeeded or failed for good
+        retry_entries = list()
+        for entry, item in zip(entries, r.json()["items"]):
+            result = next(iter(item.values()))
+            if result["status"] < 300 or (result["status"] == 404 and "delete" in item):
+                indexed += 1
+            elif is_retryable_status(result["status"]):
+                retry_entries.append(entry)
+            else:
+                failed += 1
+                print("send_bulk_chunk(): " + json.dumps(result.get("error")))
+
+        if not retry_entries:
+            return indexed, failed
+        entries = retry_entries
+
+    return indexed, failed + len(entries)
+
+
+def get_index_settings(names, index_name=None):
+    # Settings that were never set explicitly come back as None, which resets
+    # them to the cluster default when written back
+    url = es_client.index_path("/_settings?flat_settings=true", index_name)
+    settings = dict()
+    for index_settings in es_client.get(url, guarded=False).json().values():
+        for name in names:
+            settings[name] = index_settings["settings"].get("index." + name)
+    return settings
+
+
+def put_index_settings(settings, index_name=None):
+    url = es_client.index_path("/_settings", index_name)
+    r = es_client.put(url, json={"index": settings}, guarded=False)
+    print("put_index_settings(): " + str(r.status_code))
+
+
+def index_bulk_data(json_payload, full_load=False, max_docs=None, max_bytes=None, workers=None, index_name=None,
+                    checkpoint=None):
+    # With a checkpoint, the chunks it already acknowledges are skipped and
+    # the count is advanced and saved as chunks succeed. Chunks finish out of
+    # order, so only the unbroken run from the start is counted.
+    workers = workers or BULK_WORKERS
+    skip_chunks = checkpoint["acknowledged"] if checkpoint is not None else 0
+
+    saved_settings = None
+    if full_load:
+        # Refreshing and replicating while the whole corpus streams in is
+        # wasted work, both are restored once the load is done. A resumed
+        # load restores what the first attempt found, not what it left behind.
+        if checkpoint is not None and checkpoint.get("settings") is not None:
+            saved_settings = checkpoint["settings"]
+        else:
+            saved_settings = get_index_settings(["refresh_interval", "number_of_replicas"], index_name)
+            if checkpoint is not None:
+                checkpoint["settings"] = saved_settings
+                save_checkpoint(checkpoint)
+        put_index_settings({"refresh_interval": "-1", "number_of_replicas": 0}, index_name)
+
+    totals = {"indexed": 0, "failed": 0}
+    totals_lock = Lock()
+    acknowledged_chunks = set()
+    # Bounds the number of chunks held in memory while the workers are busy
+    in_flight = BoundedSemaphore(workers * 2)
+
+    def on_chunk_done(future, chunk_number, chunk_size):
+        in_flight.release()
+        # Anything send_bulk_chunk did not expect, like a 200 that is not a
+        # bulk response, fails the whole chunk instead of vanishing
+        try:
+            indexed, failed = future.result()
+        except Exception as e:
+            print("index_bulk_data(): chunk " + str(chunk_number) + " crashed: " + repr(e))
+            indexed, failed = 0, chunk_size
+        with totals_lock:
+            totals["indexed"] += indexed
+            totals["failed"] += failed
+            if checkpoint is None or failed > 0:
+                return
+
+            acknowledged_chunks.add(chunk_number)
+            acknowledged = checkpoint["acknowledged"]
+            while acknowledged in acknowledged_chunks:
+                acknowledged_chunks.discard(acknowledged)
+                acknowledged += 1
+            if acknowledged > checkpoint["acknowledged"]:
+                checkpoint["acknowledged"] = acknowledged
+                save_checkpoint(checkpoint)
+
+    if skip_chunks:
+        print("index_bulk_data(): resuming after " + str(skip_chunks) + " acknowledged chunks")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = iter_bulk_chunks(iter_bulk_entries(json_payload), max_docs, max_bytes)
+            for chunk_number, chunk in enumerate(chunks):
+                if chunk_number < skip_chunks:
+                    continue
+                in_flight.acquire()
+                future = executor.submit(send_bulk_chunk, chunk, index_name)
+                future.add_done_callback(partial(on_chunk_done, chunk_number=chunk_number, chunk_size=len(chunk)))
+    finally:
+        if saved_settings is not None:
+            put_index_settings(saved_settings, index_name)
+
+    r = es_client.post(es_client.index_path("/_refresh", index_name), timeout=es_client.bulk_timeout(),
+                       guarded=False)
+    # A named index is not live yet, or never will be. Searches only see
+    # it once swap_alias() points the alias at it.
+    if index_name is None:
+        index_changed()
+    print("index_bulk_data(): " + str(r.status_code) + " indexed=" + str(totals["indexed"]) +
+          " failed=" + str(totals["failed"]))
+    return totals
+
+
+def index_exists(index_name=None):
+    return es_client.head(es_client.index_path("", index_name)).status_code == 200
+
+
+def index_delta_data(full_load=False, index_name=None, checkpoint=None):
+    manifest = dict() if full_load else load_manifest() or dict()
+    new_manifest = dict()
+
+    totals = index_bulk_data(generate_delta_data(manifest, new_manifest), full_load=full_load, index_name=index_name,
+                             checkpoint=checkpoint)
+    # With failures the old manifest is kept, so the next run sends every
+    # topic that changed since the last clean load again
+    if totals["failed"] == 0:
+        save_manifest(new_manifest)
+    return totals
+
+
+def get_alias_indices():
+    r = es_client.get("/_alias/" + es_client.INDEX_NAME)
+    if r.status_code == 404:
+        return list()
+    return list(r.json().keys())
+
+
+def warm_up_index(index_name):
+    # Runs the head queries through every profile so caches and the
+    # global ordinals are loaded before the index takes traffic
+    url = es_client.index_path("/_search", index_name)
+    for query in WARM_UP_QUERIES:
+        for query_kind in ("", "condition", "symptom"):
+            es_client.get(url, headers=JSON_HEADERS, data=render_search_payload(query_kind, query, 0))
+
+
+def swap_alias(index_name):
+    alias = es_client.INDEX_NAME
+    live = get_alias_indices()
+    actions = [{"remove": {"index": old_index, "alias": alias}} for old_index in live if old_index != index_name]
+    actions.append({"add": {"index": index_name, "alias": alias}})
+
+    # A concrete index left over from before aliases were used has the
+    # alias name itself, it is dropped in the same atomic update
+    if not live and index_exists():
+        actions.append({"remove_index": {"index": alias}})
+
+    r = es_client.post("/_aliases", json={"actions": actions})
+    index_changed()
+    print("swap_alias(): " + str(r.status_code) + " " + alias + " -> " + index_name)
+
+
+def delete_old_indices(keep=None):
+    keep = keep or INDEX_VERSIONS_KEPT
+    prefix = es_client.INDEX_NAME + "-"
+
+    r = es_client.get("/_cat/indices/" + prefix + "*?h=index&format=json")
+    versions = sorted((row["index"] for row in r.json() if row["index"].startswith(prefix)), reverse=True)
+    live = set(get_alias_indices())
+
+    for index_name in versions[keep:]:
+        if index_name not in live:
+            r = es_client.delete(es_client.index_path("", index_name))
+            print("delete_old_indices(): " + str(r.status_code) + " " + index_name)
+
+
+def rebuild_index(checkpoint=None):
+    # Builds a new versioned index next to the live one and only points the
+    # alias at it once it is loaded, so searches never see a missing index.
+    # A checkpointed rebuild that was interrupted continues in the index it
+    # had already created.
+    read_synonyms()
+    if checkpoint is not None and checkpoint.get("index"):
+        index_name = checkpoint["index"]
+    else:
+        index_name = create_index()
+        if checkpoint is not None:
+            checkpoint["index"] = index_name
+            save_checkpoint(checkpoint)
+    totals = index_delta_data(full_load=True, index_name=index_name, checkpoint=checkpoint)
+    if totals["failed"] > 0:
+        print("rebuild_index(): " + str(totals["failed"]) + " documents failed, keeping the current index")
+        return None
+
+    warm_up_index(index_name)
+    swap_alias(index_name)
+    delete_old_indices()
+    return index_name
 
 
 def parse_int(value):
@@ -443,25 +867,81 @@ def parse_int(value):
         return value, False
 
 
+def parse_flag(value):
+    return value is not None and value.lower() in ("1", "true", "yes")
+
+
+def parse_highlight(value):
+    # On unless turned off explicitly, API and bulk consumers that never
+    # show snippets pass highlight=0
+    return value is None or parse_flag(value)
+
+
+def parse_json_flag(value, default=False):
+    # JSON bodies may send a real boolean or the strings the query string takes
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return parse_flag(str(value))
+
+
 @app.route('/document/<doc_id>', methods=['GET'])
 @cross_origin()
 def get_document_by_id(doc_id):
-    url = "http://localhost:9200/mayoc-index/_doc/" + doc_id + "?pretty"
+    cached = document_cache.get(doc_id)
+    if cached is not None:
+        return Response(cached, content_type="application/json")
 
-    r = requests.get(url)
-    print("get_document_by_id(): " + str(r.status_code))
-    print(r.text)
-    return r.text
+    url = es_client.index_path("/_doc/" + doc_id)
 
+    try:
+        r = es_client.get(url, timeout=es_client.search_timeout())
+    except requests.RequestException as e:
+        return stale_response(("document", doc_id), e)
+    log.debug("get_document_by_id(): %d", r.status_code)
+    if es_client.is_unhealthy_status(r.status_code):
+        return stale_response(("document", doc_id), r.status_code)
+    if r.status_code == 200:
+        document_cache.put(doc_id, r.content)
+        stale_cache.put(("document", doc_id), r.content)
+    return Response(r.content, status=r.status_code, content_type="application/json")
 
-@app.route('/search', methods=['POST', 'GET'])
+
+@app.route('/documents', methods=['GET'])
 @cross_origin()
-def evaluate_query():
-    query_param = request.args.get('q')
-    from_param = request.args.get('from')
+def get_documents_by_ids():
+    ids = [doc_id for doc_id in request.args.get('ids', "").split(",") if doc_id]
+    if len(ids) == 0 or len(ids) > DOCUMENTS_MAX_IDS:
+        return Response(status=400)
+
+    # _doc and _mget return the same document shape, so both endpoints share
+    # one cache and only the misses go out, in a single _mget
+    docs = dict()
+    for doc_id in ids:
+        cached = document_cache.get(doc_id)
+        if cached is not None:
+            docs[doc_id] = cached
+
+    missing = [doc_id for doc_id in dict.fromkeys(ids) if doc_id not in docs]
+    if missing:
+        r = es_client.post(es_client.index_path("/_mget"), json={"ids": missing}, timeout=es_client.search_timeout())
+        log.debug("get_documents_by_ids(): %d ids=%d", r.status_code, len(missing))
+        if r.status_code != 200:
+            return Response(r.content, status=r.status_code, content_type="application/json")
+
+        for doc in r.json()["docs"]:
+            body = json.dumps(doc).encode("utf-8")
+            docs[doc["_id"]] = body
+            if doc.get("found"):
+                document_cache.put(doc["_id"], body)
 
+    return Response(b'{"docs": [' + b", ".join(docs[doc_id] for doc_id in ids) + b']}', content_type="application/json")
+
+
+def parse_search_query(query_param, from_param):
     if query_param is None:
-        return
+        return None
 
     search_from = 0
     if from_param is not None and parse_int(from_param)[1]:
@@ -469,7 +949,7 @@ def evaluate_query():
 
     search_query = query_param.strip()
     if len(search_query) == 0:
-        return
+        return None
 
     split_query = search_query.split(":", 1)
     if len(split_query) == 1:
@@ -479,124 +959,361 @@ def evaluate_query():
         query_kind = split_query[0].strip().lower()
         query = split_query[1].strip()
 
-    print(query)
-
-    url = "http://localhost:9200/mayoc-index/_search?pretty"
-    if len(query_kind) > 0 and query_kind == "condition" or query_kind == "illness":
-        payload = {
-            "_source": ["*"],
-            "from": search_from,
-            "size": "15",
-            "query": {
-                "query_string": {
-                    "fields": [
-                        "@title^4",
-                        "mesh-heading^4",
-                        "also-called^4"
-                    ],
-                    "query": query
-                }
-            },
-            "highlight": {
-                "require_field_match": "false",
-                "pre_tags": ["<strong>"],
-                "post_tags": ["</strong>"],
-                "fields": {
-                    "@meta-desc": {},
-                    "full-summary": {}
-                },
-                "type": "unified"
-            }
-        }
-    elif len(query_kind) > 0 and query_kind == "symptom":
-        payload = {
-            "_source": ["*"],
-            "from": search_from,
-            "size": "15",
-            "query": {
-                "query_string": {
-                    "fields": [
-                        "@meta-desc^4",
-                        "full-summary^5",
-                        "site.information-category^5",
-                        "site.title^5",
-                        "related-topic.#text^3",
-                        "*"
-                    ],
-                    "query": query
-                }
-            },
-            "highlight": {
-                "require_field_match": "false",
-                "pre_tags": ["<strong>"],
-                "post_tags": ["</strong>"],
-                "fields": {
-                    "@meta-desc": {},
-                    "full-summary": {}
-                },
-                "type": "unified"
-            }
-        }
+    analyzer = get_query_analyzer() if QUERY_ANALYSIS else None
+    if analyzer is not None:
+        query = analyzer.analyze(query)
+
+    return query_kind, query, search_from
+
+
+def normalize_query(query):
+    # Terms are lowercased by the analyzers anyway, but the query_string
+    # operators and field names are case sensitive so those queries are
+    # left as they are
+    words = query.split()
+    if BOOLEAN_OPERATORS.isdisjoint(words) and ":" not in query:
+        words = [word.lower() for word in words]
+    return " ".join(words)
+
+
+def search_cache_key(query_kind, query, search_from, compact=False, highlight=True):
+    return query_kind, normalize_query(query), search_from, SEARCH_PAGE_SIZE, compact, highlight
+
+
+def build_search_payload(query_kind, query, search_from, compact=False, highlight=True, size=SEARCH_PAGE_SIZE):
+    return render_search_payload(query_kind, query, search_from, compact, highlight, size)
+
+
+def search_url(compact=False):
+    if compact:
+        return es_client.index_path("/_search?" + es_client.deadline_param() + "&filter_path=" + COMPACT_FILTER_PATH)
+    return es_client.index_path("/_search?pretty&" + es_client.deadline_param())
+
+
+def remember_search(cache_key, body):
+    # Partial results of a search that ran out of time are returned once
+    # but never cached
+    head = body[:128].encode("utf-8") if isinstance(body, str) else body[:128]
+    if TIMED_OUT_PATTERN.search(head):
+        return
+    search_cache.put(cache_key, body)
+    stale_cache.put(cache_key, body)
+
+
+def stale_response(cache_key, reason):
+    stale = stale_cache.get(cache_key)
+    log.warning("stale_response(): elasticsearch unavailable (%s), %s", reason,
+                "serving the last good result" if stale is not None else "nothing to fall back to")
+    if stale is None:
+        return Response(UNAVAILABLE_BODY, status=503, content_type="application/json")
+    return Response(stale, content_type="application/json", headers={"Warning": '110 - "Response is Stale"'})
+
+
+def observe_took(body, endpoint):
+    if isinstance(body, str):
+        body = body[:64].encode("utf-8")
+    match = TOOK_PATTERN.search(body[:64])
+    if match is not None:
+        ES_TOOK_SECONDS.observe(int(match.group(1)) / 1000.0, endpoint)
+
+
+def finish_request_timing(timer, endpoint, query_kind, query):
+    total = timer.finish(REQUEST_STAGE_SECONDS, endpoint)
+    if total * 1000 >= SLOW_QUERY_MS:
+        log.warning("slow %s %.1f ms kind=%r query=%r stages=%s", endpoint, total * 1000, query_kind, query,
+                    " ".join("%s=%.1f" % (stage, seconds * 1000) for stage, seconds in timer.stages))
+
+
+def stream_search_response(r, cache_key, timer, query_kind, query):
+    # Chunks go out to the client as they arrive from ES, and the full body
+    # is only cached once it has been read completely
+    chunks = list()
+    try:
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+            chunks.append(chunk)
+            yield chunk
+    finally:
+        r.close()
+
+    if chunks:
+        observe_took(chunks[0], "search")
+    if r.status_code == 200:
+        remember_search(cache_key, b"".join(chunks))
+    timer.mark("serialize")
+    finish_request_timing(timer, "search", query_kind, query)
+
+
+def evaluate_reranked_query(url, cache_key, timer, parsed, compact, highlight):
+    # The top hits down to the re-rank depth are fetched in one go and
+    # re-ordered locally, every page inside that depth is cut from the
+    # re-ranked list
+    query_kind, query, search_from = parsed
+    payload = build_search_payload(query_kind, query, 0, compact, highlight, rerank.rerank_depth(SEARCH_PAGE_SIZE))
+    timer.mark("build")
+
+    try:
+        r = es_client.get(url, headers=JSON_HEADERS, data=payload, timeout=es_client.search_timeout())
+    except requests.RequestException as e:
+        return stale_response(cache_key, e)
+    timer.mark("es")
+    observe_took(r.content, "search")
+    if es_client.is_unhealthy_status(r.status_code):
+        return stale_response(cache_key, r.status_code)
+    if r.status_code != 200:
+        return Response(r.content, status=r.status_code, content_type="application/json")
+
+    body = json.dumps(rerank.rerank_result(r.json(), query, search_from, SEARCH_PAGE_SIZE, DOCUMENT_SRC_FOLDER))
+    timer.mark("rerank")
+    remember_search(cache_key, body)
+    timer.mark("serialize")
+    finish_request_timing(timer, "search", query_kind, query)
+    return Response(body, content_type="application/json")
+
+
+def open_point_in_time():
+    r = es_client.post(es_client.index_path("/_pit?keep_alive=" + CURSOR_KEEP_ALIVE))
+    return r.json()["id"]
+
+
+def close_point_in_time(pit_id):
+    r = es_client.delete("/_pit", json={"id": pit_id})
+    log.debug("close_point_in_time(): %d", r.status_code)
+
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, binascii.Error):
+        return None
+
+    if not isinstance(state, dict) or not {"kind", "query", "pit", "after", "compact"} <= state.keys():
+        return None
+    return state
+
+
+def evaluate_cursor_query(parsed, compact, highlight, cursor_param):
+    if cursor_param is not None:
+        state = decode_cursor(cursor_param)
+        if state is None:
+            return Response(status=400)
+    elif parsed is None:
+        return
     else:
-        payload = {
-            "_source": ["*"],
-            "from": search_from,
-            "size": "15",
-            "query": {
-                "query_string": {
-                    "fields": [
-                        "@title^8",
-                        "mesh-heading^8",
-                        "also-called^8",
-                        "see-reference^8",
-                        "@meta-desc^7",
-                        "full-summary^7",
-                        "site.information-category^5",
-                        "site.title^5",
-                        "related-topic.#text^2",
-                        "*"
-                    ],
-                    "query": query,
-                    "analyze_wildcard": "true"
-                }
-            },
-            "highlight": {
-                "require_field_match": "false",
-                "pre_tags": ["<strong>"],
-                "post_tags": ["</strong>"],
-                "fields": {
-                    "@meta-desc": {},
-                    "full-summary": {}
-                },
-                "type": "unified"
-            }
-        }
+        query_kind, query, _ = parsed
+        state = {"kind": query_kind, "query": query, "pit": open_point_in_time(), "after": None, "compact": compact,
+                 "highlight": highlight}
+
+    url = "/_search?" + es_client.deadline_param()
+    if state["compact"]:
+        url += "&filter_path=" + CURSOR_FILTER_PATH
+    payload = render_cursor_payload(state["kind"], state["query"], state["pit"], state["after"], state["compact"],
+                                    state.get("highlight", True))
+
+    r = es_client.get(url, headers=JSON_HEADERS, data=payload, timeout=es_client.search_timeout())
+    log.debug("evaluate_cursor_query(): %d", r.status_code)
+    if r.status_code != 200:
+        return Response(r.content, status=r.status_code, content_type="application/json")
+
+    # The cursor carries the (possibly refreshed) PIT id and the sort values
+    # of the last hit, and is null once the result list is exhausted
+    result = r.json()
+    hits = result["hits"]["hits"]
+    if len(hits) < SEARCH_PAGE_SIZE:
+        close_point_in_time(state["pit"])
+        result["cursor"] = None
+    else:
+        state["pit"] = result.get("pit_id", state["pit"])
+        state["after"] = hits[-1]["sort"]
+        result["cursor"] = encode_cursor(state)
+
+    return Response(json.dumps(result), content_type="application/json")
+
+
+@app.route('/suggest', methods=['GET'])
+@cross_origin()
+def suggest():
+    prefix = request.args.get('q', "").strip().lower()
+    if len(prefix) == 0:
+        return Response(status=400)
+
+    cached = suggest_cache.get(prefix)
+    if cached is not None:
+        return Response(cached, content_type="application/json")
+
+    url = es_client.index_path("/_search?filter_path=" + SUGGEST_FILTER_PATH)
+    r = es_client.get(url, headers=JSON_HEADERS, data=render_suggest_payload(prefix), timeout=es_client.search_timeout())
+    if r.status_code == 200:
+        suggest_cache.put(prefix, r.content)
+    return Response(r.content, status=r.status_code, content_type="application/json")
+
+
+def multi_search(bodies):
+    # _msearch has no timeout parameter, the deadline goes into every body.
+    # The rendered bodies are compact JSON objects, never empty.
+    deadline = ('{"timeout":"' + str(es_client.SEARCH_DEADLINE_MS) + 'ms",').encode("utf-8")
+    data = b"".join(b"{}\n" + deadline + body[1:] + b"\n" for body in bodies)
+    r = es_client.post(es_client.index_path("/_msearch"), headers=NDJSON_HEADERS, data=data,
+                       timeout=es_client.search_timeout())
+    log.debug("multi_search(): %d searches=%d", r.status_code, len(bodies))
+    r.raise_for_status()
+    return r.json()["responses"]
+
+
+search_batcher = MultiSearchBatcher(multi_search, MSEARCH_WINDOW_MS / 1000, MSEARCH_MAX_BATCH)
+
+
+@app.route('/msearch', methods=['POST'])
+@cross_origin()
+def evaluate_multi_query():
+    queries = (request.get_json(silent=True) or dict()).get("queries")
+    if not isinstance(queries, list) or len(queries) == 0:
+        return Response(status=400)
+
+    results = [None] * len(queries)
+    misses = list()
+    for i, item in enumerate(queries):
+        parsed = None
+        if isinstance(item, dict) and isinstance(item.get("q"), str):
+            parsed = parse_search_query(item["q"], str(item.get("from", 0)))
+        if parsed is None:
+            results[i] = '{"status": 400}'
+            continue
+
+        query_kind, query, search_from = parsed
+        compact = parse_json_flag(item.get("compact"))
+        highlight = parse_json_flag(item.get("highlight"), True)
+        cache_key = search_cache_key(query_kind, query, search_from, compact, highlight)
+        cached = search_cache.get(cache_key)
+        if cached is not None:
+            results[i] = cached.decode("utf-8") if isinstance(cached, bytes) else cached
+            continue
+        misses.append((i, cache_key, build_search_payload(query_kind, query, search_from, compact, highlight)))
+
+    # Every miss goes out in one _msearch, shared with whatever other
+    # requests arrive inside the batching window
+    if misses:
+        responses = search_batcher.search([payload for _, _, payload in misses])
+        for (i, cache_key, _), response in zip(misses, responses):
+            results[i] = json.dumps(response)
+            if response.get("status") == 200:
+                remember_search(cache_key, results[i])
+
+    return Response('{"responses": [' + ", ".join(results) + ']}', content_type="application/json")
+
+
+@app.route('/search', methods=['POST', 'GET'])
+@cross_origin()
+def evaluate_query():
+    timer = StageTimer()
+    parsed = parse_search_query(request.args.get('q'), request.args.get('from'))
+    compact = parse_flag(request.args.get('compact'))
+    highlight = parse_highlight(request.args.get('highlight'))
+
+    cursor_param = request.args.get('cursor')
+    if cursor_param is not None or request.args.get('paging') == "cursor":
+        return evaluate_cursor_query(parsed, compact, highlight, cursor_param)
+
+    if parsed is None:
+        return
+
+    query_kind, query, search_from = parsed
+    cache_key = search_cache_key(query_kind, query, search_from, compact, highlight)
+    timer.mark("parse")
+
+    cached = search_cache.get(cache_key)
+    if cached is not None:
+        timer.mark("cache")
+        finish_request_timing(timer, "search", query_kind, query)
+        if compact:
+            return Response(cached, content_type="application/json")
+        return cached
+
+    url = search_url(compact)
+    if rerank.reranks(query_kind, search_from, SEARCH_PAGE_SIZE, DOCUMENT_SRC_FOLDER):
+        return evaluate_reranked_query(url, cache_key, timer, parsed, compact, highlight)
+
+    payload = build_search_payload(query_kind, query, search_from, compact, highlight)
+    timer.mark("build")
+
+    if COALESCE_SEARCHES and not compact:
+        try:
+            response = search_batcher.search([payload])[0]
+        except requests.RequestException as e:
+            return stale_response(cache_key, e)
+        timer.mark("es")
+        if es_client.is_unhealthy_status(response.get("status", 200)):
+            return stale_response(cache_key, response.get("status"))
+        if "took" in response:
+            ES_TOOK_SECONDS.observe(response["took"] / 1000.0, "search")
+        body = json.dumps(response)
+        if response.get("status") == 200:
+            remember_search(cache_key, body)
+        timer.mark("serialize")
+        finish_request_timing(timer, "search", query_kind, query)
+        return body
 
     # print(payload)
-    r = requests.get(url, json=payload)
-    print("evaluate_query_simple(): " + str(r.status_code))
-    # print(r.text)
-    return r.text
+    try:
+        r = es_client.get(url, headers=JSON_HEADERS, data=payload, stream=compact, timeout=es_client.search_timeout())
+    except requests.RequestException as e:
+        return stale_response(cache_key, e)
+    timer.mark("es")
+    log.debug("evaluate_query_simple(): %d", r.status_code)
+    if es_client.is_unhealthy_status(r.status_code):
+        r.close()
+        return stale_response(cache_key, r.status_code)
+    if compact:
+        return Response(stream_search_response(r, cache_key, timer, query_kind, query),
+                        status=r.status_code, content_type="application/json")
+
+    body = r.text
+    observe_took(body, "search")
+    if r.status_code == 200:
+        remember_search(cache_key, body)
+    timer.mark("serialize")
+    finish_request_timing(timer, "search", query_kind, query)
+    return body
+
+
+@app.before_request
+def watch_index_generation():
+    check_index_generation()
+
+
+@app.errorhandler(requests.RequestException)
+def elasticsearch_unavailable(e):
+    # Timeouts, refused connections and an open circuit end up here for the
+    # endpoints without a stale fallback
+    log.warning("elasticsearch_unavailable(): %s", e)
+    return Response(UNAVAILABLE_BODY, status=503, content_type="application/json")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4")
 
 
 def analyze(input_text):
-    url = "http://localhost:9200/mayoc-index/_analyze?pretty"
+    url = es_client.index_path("/_analyze?pretty")
     payload = {
         # "analyzer": "custom_search_stop_analyzer",
         "field": "@title",
         "text": input_text
     }
 
-    r = requests.get(url, json=payload)
+    r = es_client.get(url, json=payload)
     print("analyze(): " + str(r.status_code))
     print(r.text)
 
 
 if __name__ == "__main__":
-    read_synonyms()
-    create_index()
-    index_bulk_data(generate_data())
-
+    # Development server only, indexing is done by ingest.py and production
+    # serving by serve.py
+    refresh_query_analyzer()
     app.run(host="localhost", port=4001)
 
 # phrase = "Quick brown fox's   jumps"
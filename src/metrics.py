@@ -0,0 +1,140 @@
+import os
+import json
+import time
+
+from bisect import bisect_left
+from threading import Lock, Thread
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SNAPSHOT_INTERVAL = float(os.environ.get("SUPERDOC_METRICS_SNAPSHOT_INTERVAL", 1))
+
+REGISTRY = list()
+# Set in prefork workers. Each worker labels its series with its slot and
+# writes them to snapshot_dir, so whichever worker answers /metrics can
+# report the series of every worker.
+multiprocess = {"worker": None, "snapshot_dir": None}
+
+
+class Histogram:
+    # Cumulative histogram in the Prometheus text exposition format, with
+    # one series per combination of label values
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = dict()
+        self._lock = Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def snapshot(self):
+        worker = multiprocess["worker"]
+        extra = [worker] if worker is not None else []
+        with self._lock:
+            return [[list(label_values) + extra, list(counts), total, count]
+                    for label_values, (counts, total, count) in self._series.items()]
+
+    def render(self, other_series=()):
+        label_names = self.label_names + (("worker",) if multiprocess["worker"] is not None else ())
+        series = [(tuple(label_values), counts, total, count)
+                  for label_values, counts, total, count in self.snapshot() + list(other_series)]
+
+        lines = ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " histogram"]
+        for label_values, counts, total, count in sorted(series, key=lambda item: item[0]):
+            labels = ['%s="%s"' % (name, value) for name, value in zip(label_names, label_values)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket_labels = ",".join(labels + ['le="%s"' % bound])
+                lines.append("%s_bucket{%s} %d" % (self.name, bucket_labels, cumulative))
+            suffix = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append("%s_sum%s %f" % (self.name, suffix, total))
+            lines.append("%s_count%s %d" % (self.name, suffix, count))
+        return "\n".join(lines)
+
+
+class StageTimer:
+    # Splits one request into consecutive stages: mark(stage) closes the
+    # stage that has been running since the previous mark
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages = list()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def finish(self, histogram, endpoint):
+        total = time.perf_counter() - self.start
+        for stage, seconds in self.stages:
+            histogram.observe(seconds, endpoint, stage)
+        histogram.observe(total, endpoint, "total")
+        return total
+
+
+def snapshot_file(worker):
+    return os.path.join(multiprocess["snapshot_dir"], "worker-" + worker + ".json")
+
+
+def write_snapshot():
+    # Written aside and renamed, a reader never sees half a snapshot
+    path = snapshot_file(multiprocess["worker"])
+    with open(path + ".tmp", "w") as snapshot:
+        json.dump({metric.name: metric.snapshot() for metric in REGISTRY}, snapshot)
+    os.replace(path + ".tmp", path)
+
+
+def read_snapshots():
+    # Series of the other workers as of their last snapshot, at most
+    # SNAPSHOT_INTERVAL old
+    series = dict()
+    if multiprocess["snapshot_dir"] is None:
+        return series
+
+    own = snapshot_file(multiprocess["worker"])
+    for file_name in os.listdir(multiprocess["snapshot_dir"]):
+        path = os.path.join(multiprocess["snapshot_dir"], file_name)
+        if not file_name.endswith(".json") or path == own:
+            continue
+        try:
+            with open(path) as snapshot:
+                for name, metric_series in json.load(snapshot).items():
+                    series.setdefault(name, list()).extend(metric_series)
+        except (OSError, ValueError):
+            continue
+    return series
+
+
+def start_snapshots(snapshot_dir, worker):
+    # Called in the worker after the fork, the thread does not survive one.
+    # A restarted worker takes over the slot and the file of the one it
+    # replaces, its counts start again from zero like any process restart.
+    multiprocess.update(worker=str(worker), snapshot_dir=snapshot_dir)
+
+    def run():
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                write_snapshot()
+            except OSError:
+                return
+
+    Thread(target=run, daemon=True).start()
+
+
+def render_metrics():
+    others = read_snapshots()
+    return "\n".join(metric.render(others.get(metric.name, ())) for metric in REGISTRY) + "\n"
@@ -0,0 +1,52 @@
+import time
+
+from concurrent.futures import Future
+from threading import Lock
+
+
+class MultiSearchBatcher:
+    # Coalesces searches from concurrent requests into one _msearch round
+    # trip. The first caller to find the queue empty becomes the leader: it
+    # waits one window for others to join and then sends everything queued.
+    # A full batch is sent right away by whoever filled it.
+
+    def __init__(self, send, window=0.005, max_batch=64):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = list()
+        self._lock = Lock()
+
+    def search(self, bodies):
+        futures = [Future() for _ in bodies]
+        with self._lock:
+            leader = len(self._pending) == 0
+            self._pending.extend(zip(bodies, futures))
+            full = len(self._pending) >= self.max_batch
+
+        if full:
+            self.flush()
+        elif leader:
+            time.sleep(self.window)
+            self.flush()
+
+        return [future.result() for future in futures]
+
+    def flush(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+
+            if not batch:
+                return
+
+            try:
+                responses = self.send([body for body, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), response in zip(batch, responses):
+                future.set_result(response)
@@ -0,0 +1,67 @@
+import re
+
+# Anything that looks like query_string syntax is passed through untouched,
+# the user meant it literally
+QUERY_SYNTAX = re.compile(r'["()\[\]{}*?~^:/\\]|(^|\s)[+\-!]|\b(AND|OR|NOT)\b|&&|\|\|')
+# A question or exclamation mark ending a word closes a sentence, it is
+# not a wildcard or an operator
+SENTENCE_PUNCTUATION = re.compile(r"[?!]+(?=\s|$)")
+TOKEN_PUNCTUATION = ".,;!?'"
+
+
+def nGrams(query):
+    grams = list()
+    words = query.lower().split()
+    n = len(words)
+
+    for k in range(n, 0, -1):
+        for i in range(n - k + 1):
+            grams.append(' '.join(words[i:i + k]))
+    return grams
+
+
+class QueryAnalyzer:
+    # Canonicalizes free-text queries before they reach ES: lowercases,
+    # quotes known multi-word medical phrases (titles, alternative names and
+    # synonym terms) so they run as phrase queries, and drops stopwords from
+    # the remaining words. Equivalent queries end up as the same string,
+    # which is also what the result cache is keyed on.
+
+    def __init__(self, stopwords, phrases):
+        self.stopwords = frozenset(word.lower() for word in stopwords)
+        self.phrases = frozenset(phrase.lower() for phrase in phrases if " " in phrase.strip())
+
+    def analyze(self, query):
+        if QUERY_SYNTAX.search(SENTENCE_PUNCTUATION.sub("", query)):
+            return query
+
+        words = [word.strip(TOKEN_PUNCTUATION) for word in query.lower().split()]
+        words = [word for word in words if word]
+        if not words:
+            return query
+
+        # nGrams yields the longest grams first, so longer phrases win over
+        # the shorter ones they contain
+        phrase_at = dict()
+        covered = set()
+        for gram in nGrams(" ".join(words)):
+            if " " not in gram or gram not in self.phrases:
+                continue
+            size = gram.count(" ") + 1
+            for i in range(len(words) - size + 1):
+                span = range(i, i + size)
+                if " ".join(words[i:i + size]) == gram and covered.isdisjoint(span):
+                    phrase_at[i] = gram
+                    covered.update(span)
+
+        terms = list()
+        for i, word in enumerate(words):
+            if i in phrase_at:
+                terms.append('"' + phrase_at[i] + '"')
+            elif i not in covered and word not in self.stopwords:
+                terms.append(word)
+
+        # A query made only of stopwords is left as typed
+        if not terms:
+            return " ".join(words)
+        return " ".join(terms)
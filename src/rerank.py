@@ -0,0 +1,206 @@
+import os
+import re
+import json
+import zlib
+import logging
+
+from functools import lru_cache
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger("superdoc")
+
+RERANK_KINDS = set(kind.strip() for kind in os.environ.get("SUPERDOC_RERANK_KINDS", "symptom").split(",") if kind.strip())
+RERANK_DEPTH = int(os.environ.get("SUPERDOC_RERANK_DEPTH", 50))
+RERANK_WEIGHT = float(os.environ.get("SUPERDOC_RERANK_WEIGHT", 0.3))
+HASH_DIM = int(os.environ.get("SUPERDOC_EMBEDDING_HASH_DIM", 512))
+WORD_VECTORS_PATH = os.environ.get("SUPERDOC_WORD_VECTORS")
+EMBEDDINGS_FILE = "embeddings.npy"
+EMBEDDING_IDS_FILE = "embedding_ids.json"
+EMBED_BATCH = 256
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+TAG_PATTERN = re.compile(r"<[^>]+>")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(TAG_PATTERN.sub(" ", text or "").lower())
+
+
+def stable_hash(feature):
+    # Python's hash() is salted per process, the ingest and every server
+    # worker must map a feature to the same column
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+def load_word_vectors(path):
+    # Plain text vectors, one "word v1 v2 ..." per line as GloVe and fastText
+    # ship them. A fastText header line is skipped.
+    words = dict()
+    rows = list()
+    with open(path, encoding="utf-8") as vectors_file:
+        for line in vectors_file:
+            parts = line.rstrip().split(" ")
+            if len(parts) <= 2:
+                continue
+            words[parts[0]] = len(rows)
+            rows.append([float(value) for value in parts[1:]])
+    return words, numpy.asarray(rows, dtype=numpy.float32)
+
+
+class TextEmbedder:
+    # Offline CPU embedding: word and character trigram features hashed into
+    # HASH_DIM columns, which matches inflections and misspellings ("tight",
+    # "tightness"), and, when local word vectors are configured, the mean
+    # vector of the known words, which matches lay wording to clinical terms.
+
+    def __init__(self, hash_dim=HASH_DIM, word_vectors_path=None):
+        self.hash_dim = hash_dim
+        self.word_vectors_path = word_vectors_path
+        self.words = dict()
+        self.vectors = None
+        if word_vectors_path:
+            self.words, self.vectors = load_word_vectors(word_vectors_path)
+        self.dim = hash_dim + (self.vectors.shape[1] if self.vectors is not None else 0)
+
+    def signature(self):
+        # Stored with the embeddings, vectors made by a different embedder
+        # are not comparable with the query vectors
+        return {"hash_dim": self.hash_dim, "word_vectors": os.path.basename(self.word_vectors_path or ""),
+                "dim": self.dim}
+
+    def embed(self, texts):
+        matrix = numpy.zeros((len(texts), self.dim), dtype=numpy.float32)
+        for i, text in enumerate(texts):
+            tokens = tokenize(text)
+            for token in tokens:
+                features = [token]
+                if len(token) > 3:
+                    features += [token[j:j + 3] for j in range(len(token) - 2)]
+                for feature in features:
+                    h = stable_hash(feature)
+                    matrix[i, h % self.hash_dim] += 1.0 if h & 0x80000000 else -1.0
+
+            if self.vectors is not None:
+                rows = [self.words[token] for token in tokens if token in self.words]
+                if rows:
+                    word_part = self.vectors[rows].mean(axis=0)
+                    matrix[i, self.hash_dim:] = word_part / (numpy.linalg.norm(word_part) or 1.0)
+
+        norms = numpy.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+
+@lru_cache(maxsize=None)
+def get_embedder():
+    return TextEmbedder(HASH_DIM, WORD_VECTORS_PATH)
+
+
+def topic_text(topic):
+    return " ".join([topic.title or "", " ".join(topic.also_called), " ".join(topic.mesh_headings),
+                     topic.meta_desc or "", topic.full_summary or ""])
+
+
+def write_embeddings(actions, folder):
+    # One row per topic in a .npy file the servers memory-map, plus the
+    # doc_id order. Both are written aside and renamed into place.
+    embedder = get_embedder()
+    ids = list()
+    batches = list()
+    texts = list()
+    for doc_id, topic in actions:
+        ids.append(doc_id)
+        texts.append(topic_text(topic))
+        if len(texts) == EMBED_BATCH:
+            batches.append(embedder.embed(texts))
+            texts = list()
+    if texts:
+        batches.append(embedder.embed(texts))
+
+    matrix = numpy.concatenate(batches) if batches else numpy.zeros((0, embedder.dim), dtype=numpy.float32)
+    path = os.path.join(folder, EMBEDDINGS_FILE)
+    with open(path + ".tmp", "wb") as embeddings_file:
+        numpy.save(embeddings_file, matrix)
+    os.replace(path + ".tmp", path)
+
+    ids_path = os.path.join(folder, EMBEDDING_IDS_FILE)
+    with open(ids_path + ".tmp", "w") as ids_file:
+        json.dump(dict(embedder.signature(), ids=ids), ids_file)
+    os.replace(ids_path + ".tmp", ids_path)
+
+    print("write_embeddings(): " + str(len(ids)) + " topics dim=" + str(embedder.dim))
+    return len(ids)
+
+
+loaded_embeddings = {"mtime": None, "matrix": None, "rows": None}
+loaded_embeddings_lock = Lock()
+
+
+def load_embeddings(folder):
+    # Memory-mapped, so every worker shares the page cache instead of
+    # holding its own copy. Reloaded when an ingest replaces the file.
+    ids_path = os.path.join(folder, EMBEDDING_IDS_FILE)
+    try:
+        mtime = os.stat(ids_path).st_mtime_ns
+    except OSError:
+        return None, None
+
+    with loaded_embeddings_lock:
+        if loaded_embeddings["mtime"] != mtime:
+            with open(ids_path) as ids_file:
+                stored = json.load(ids_file)
+            if {key: stored.get(key) for key in get_embedder().signature()} != get_embedder().signature():
+                log.warning("load_embeddings(): embeddings were made with a different embedder, re-run the ingest")
+                matrix, rows = None, None
+            else:
+                matrix = numpy.load(os.path.join(folder, EMBEDDINGS_FILE), mmap_mode="r")
+                rows = {doc_id: row for row, doc_id in enumerate(stored["ids"])}
+            loaded_embeddings.update(mtime=mtime, matrix=matrix, rows=rows)
+        return loaded_embeddings["matrix"], loaded_embeddings["rows"]
+
+
+def available():
+    # Hashed words and trigrams only repeat the lexical overlap BM25 has
+    # already scored, re-ranking is worth its deeper fetch only with word
+    # vectors that match lay wording to clinical terms
+    return numpy is not None and bool(WORD_VECTORS_PATH)
+
+
+def rerank_depth(size):
+    # Whole pages only, so the re-ranked pages and the plain ES pages after
+    # them meet exactly at the depth without skipping or repeating hits
+    return max(size, RERANK_DEPTH // size * size)
+
+
+def reranks(query_kind, search_from, size, folder):
+    if not available() or query_kind not in RERANK_KINDS or search_from + size > rerank_depth(size):
+        return False
+    # Without embeddings re-ranking would only fetch a deeper page for nothing
+    return load_embeddings(folder)[0] is not None
+
+
+def rerank_result(result, query, search_from, size, folder):
+    # Blends the ES score, scaled to the best hit, with the cosine similarity
+    # of query and topic, and returns the requested page of the new order.
+    # Hits without an embedding only keep their ES share.
+    hits = result["hits"]["hits"]
+    matrix, rows = load_embeddings(folder)
+    if hits and matrix is not None:
+        query_vector = get_embedder().embed([query])[0]
+        known = [i for i, hit in enumerate(hits) if hit["_id"] in rows]
+        similarity = numpy.zeros(len(hits), dtype=numpy.float32)
+        if known:
+            similarity[known] = matrix[[rows[hits[i]["_id"]] for i in known]] @ query_vector
+
+        es_scores = numpy.asarray([hit.get("_score") or 0.0 for hit in hits], dtype=numpy.float32)
+        es_scores /= es_scores.max() or 1.0
+        combined = (1 - RERANK_WEIGHT) * es_scores + RERANK_WEIGHT * similarity
+        hits = [hits[i] for i in numpy.argsort(-combined, kind="stable")]
+
+    result["hits"]["hits"] = hits[search_from:search_from + size]
+    return result
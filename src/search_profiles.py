@@ -0,0 +1,207 @@
+import os
+import re
+import json
+
+from functools import lru_cache
+
+SEARCH_PAGE_SIZE = 15
+
+# Only what the result page renders, everything else stays in the index
+COMPACT_SOURCE_FIELDS = ["@title", "@url", "@meta-desc"]
+# The raw site/other-language lists are only needed by /document
+FULL_SOURCE = {"excludes": ["site", "other-language", "suggest"]}
+COMPACT_FILTER_PATH = ",".join([
+    "took",
+    "timed_out",
+    "hits.total",
+    "hits.hits._id",
+    "hits.hits._score",
+    "hits.hits._source",
+    "hits.hits.highlight"
+])
+# Highlighting budget. @meta-desc is one sentence and is returned whole,
+# full-summary only as a few short fragments. Both fields are indexed with
+# offsets, so the unified highlighter reads positions from the postings
+# instead of re-analyzing the text; the offset cap only bounds the fallback.
+HIGHLIGHT_FRAGMENT_SIZE = 150
+HIGHLIGHT_FRAGMENTS = 2
+HIGHLIGHT_MAX_ANALYZED_OFFSET = 100000
+CURSOR_FILTER_PATH = COMPACT_FILTER_PATH + ",pit_id,hits.hits.sort"
+CURSOR_KEEP_ALIVE = "2m"
+# @url is unique per topic and breaks score ties so search_after never
+# skips or repeats a hit
+CURSOR_SORT = [
+    {"_score": "desc"},
+    {"@url.keyword": "asc"}
+]
+
+# Every boost used by /search lives here, keyed by profile name
+SEARCH_PROFILES = {
+    "condition": {
+        "fields": [
+            "@title^4",
+            "mesh-heading^4",
+            "also-called^4"
+        ]
+    },
+    "symptom": {
+        "fields": [
+            "@meta-desc^4",
+            "full-summary^5",
+            "site-category^5",
+            "site-title^5",
+            "related-topic^3",
+            "*"
+        ]
+    },
+    "default": {
+        "fields": [
+            "@title^8",
+            "mesh-heading^8",
+            "also-called^8",
+            "see-reference^8",
+            "@meta-desc^7",
+            "full-summary^7",
+            "site-category^5",
+            "site-title^5",
+            "related-topic^2",
+            "*"
+        ],
+        "analyze_wildcard": "true"
+    }
+}
+
+# Profiles written by tuning.py, they replace the built-in ones by name
+PROFILES_PATH = os.environ.get("SUPERDOC_PROFILES_PATH")
+
+SUGGEST_SIZE = 10
+SUGGEST_FILTER_PATH = "took,suggest.topics.options.text,suggest.topics.options._id,suggest.topics.options._source"
+
+QUERY_KIND_PROFILES = {
+    "condition": "condition",
+    "illness": "condition",
+    "symptom": "symptom"
+}
+
+SLOT_PATTERN = re.compile(r'"\{\{(\w+)\}\}"')
+
+
+def slot(name):
+    return "{{" + name + "}}"
+
+
+class PayloadTemplate:
+    # A request body serialized once up front. Placeholders made with slot()
+    # split it into constant byte segments, and rendering only has to encode
+    # the slot values and join.
+
+    def __init__(self, payload):
+        serialized = json.dumps(payload, separators=(",", ":"))
+        parts = SLOT_PATTERN.split(serialized)
+        self.segments = [part.encode("utf-8") for part in parts[0::2]]
+        self.slots = parts[1::2]
+
+    def render(self, values):
+        rendered = [self.segments[0]]
+        for name, segment in zip(self.slots, self.segments[1:]):
+            rendered.append(json.dumps(values[name]).encode("utf-8"))
+            rendered.append(segment)
+        return b"".join(rendered)
+
+
+def load_profiles(path):
+    with open(path) as profiles_file:
+        return json.load(profiles_file)
+
+
+if PROFILES_PATH:
+    SEARCH_PROFILES.update(load_profiles(PROFILES_PATH))
+
+
+def profile_for_kind(query_kind):
+    return QUERY_KIND_PROFILES.get(query_kind, "default")
+
+
+def build_profile_query(profile, query):
+    query_string = {
+        "fields": profile["fields"],
+        "query": query
+    }
+    if "analyze_wildcard" in profile:
+        query_string["analyze_wildcard"] = profile["analyze_wildcard"]
+
+    return {"query_string": query_string}
+
+
+def build_profile_payload(profile_name, compact=False, cursor=None, highlight=True):
+    payload = {
+        "_source": COMPACT_SOURCE_FIELDS if compact else FULL_SOURCE,
+        "from": slot("from"),
+        "size": slot("size"),
+        "query": build_profile_query(SEARCH_PROFILES[profile_name], slot("query"))
+    }
+
+    if highlight:
+        payload["highlight"] = {
+            "require_field_match": "false",
+            "pre_tags": ["<strong>"],
+            "post_tags": ["</strong>"],
+            "fields": {
+                "@meta-desc": {
+                    "number_of_fragments": 0
+                },
+                "full-summary": {
+                    "fragment_size": HIGHLIGHT_FRAGMENT_SIZE,
+                    "number_of_fragments": HIGHLIGHT_FRAGMENTS
+                }
+            },
+            "type": "unified"
+        }
+
+    # Cursor pages run against a point in time instead of an index, and
+    # resume after the sort values of the previous page instead of from
+    if cursor is not None:
+        del payload["from"]
+        payload["pit"] = {"id": slot("pit"), "keep_alive": CURSOR_KEEP_ALIVE}
+        payload["sort"] = CURSOR_SORT
+        if cursor == "resume":
+            payload["search_after"] = slot("search_after")
+
+    return payload
+
+
+@lru_cache(maxsize=None)
+def get_search_template(profile_name, compact=False, cursor=None, highlight=True):
+    return PayloadTemplate(build_profile_payload(profile_name, compact, cursor, highlight))
+
+
+def render_search_payload(query_kind, query, search_from, compact=False, highlight=True, size=SEARCH_PAGE_SIZE):
+    template = get_search_template(profile_for_kind(query_kind), compact, None, highlight)
+    return template.render({"query": query, "from": search_from, "size": size})
+
+
+def render_cursor_payload(query_kind, query, pit_id, search_after=None, compact=False, highlight=True):
+    cursor = "start" if search_after is None else "resume"
+    template = get_search_template(profile_for_kind(query_kind), compact, cursor, highlight)
+    return template.render({"query": query, "pit": pit_id, "search_after": search_after, "size": SEARCH_PAGE_SIZE})
+
+
+@lru_cache(maxsize=None)
+def get_suggest_template():
+    return PayloadTemplate({
+        "_source": ["@title", "@url"],
+        "suggest": {
+            "topics": {
+                "prefix": slot("prefix"),
+                "completion": {
+                    "field": "suggest",
+                    "size": SUGGEST_SIZE,
+                    "skip_duplicates": "true"
+                }
+            }
+        }
+    })
+
+
+def render_suggest_payload(prefix):
+    return get_suggest_template().render({"prefix": prefix})
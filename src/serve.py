@@ -0,0 +1,126 @@
+import os
+import gc
+import signal
+import shutil
+import argparse
+import tempfile
+import requests
+import es_client
+import metrics
+import rerank
+
+from werkzeug.serving import make_server
+from search_profiles import SEARCH_PROFILES, get_search_template, get_suggest_template
+
+HOST = os.environ.get("SUPERDOC_HOST", "localhost")
+PORT = int(os.environ.get("SUPERDOC_PORT", 4001))
+WORKERS = int(os.environ.get("SUPERDOC_WORKERS", os.cpu_count() or 1))
+
+
+def warm_shared_state(main):
+    # Read-only state every worker needs. Built once in the master so the
+    # workers share the pages copy-on-write instead of each loading its own.
+    main.refresh_query_analyzer()
+    for profile_name in SEARCH_PROFILES:
+        for compact in (False, True):
+            for cursor in (None, "start", "resume"):
+                for highlight in (True, False):
+                    get_search_template(profile_name, compact, cursor, highlight)
+    get_suggest_template()
+    if rerank.available():
+        rerank.get_embedder()
+        rerank.load_embeddings(main.DOCUMENT_SRC_FOLDER)
+
+
+def run_worker(server, slot, metrics_dir):
+    # The master owns shutdown, a Ctrl-C in the terminal reaches the whole
+    # process group and would otherwise kill the workers mid-request
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    metrics.start_snapshots(metrics_dir, slot)
+    try:
+        server.serve_forever()
+    finally:
+        os._exit(0)
+
+
+def spawn_worker(server, slot, metrics_dir):
+    pid = os.fork()
+    if pid == 0:
+        run_worker(server, slot, metrics_dir)
+    return pid
+
+
+def serve(host=HOST, port=PORT, workers=WORKERS):
+    import main
+
+    try:
+        if not main.index_exists():
+            print("serve(): index " + es_client.INDEX_NAME + " not found, run ingest.py first")
+    except requests.RequestException as e:
+        # Searches get a 503 until the cluster is back, the workers start anyway
+        print("serve(): elasticsearch unreachable, " + str(e))
+
+    warm_shared_state(main)
+    # Connections opened while warming must not be shared between workers,
+    # each worker opens its own on first use
+    es_client.session.close()
+
+    # The listening socket is bound once here and inherited by every worker,
+    # the kernel hands each connection to whichever worker accepts first
+    server = make_server(host, port, main.app, threaded=True)
+    # Keeps the warmed objects out of the collector, whose bookkeeping writes
+    # would otherwise copy the shared pages into every worker
+    gc.freeze()
+
+    # Any worker may answer /metrics, each one reads the others' snapshots
+    # from here
+    metrics_dir = tempfile.mkdtemp(prefix="superdoc-metrics-")
+    pids = dict()
+    stopping = list()
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for slot in range(workers):
+        pids[spawn_worker(server, slot, metrics_dir)] = slot
+    print("serve(): http://" + host + ":" + str(port) + " workers=" + str(workers))
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = pids.pop(pid, None)
+        if not stopping and slot is not None:
+            print("serve(): worker " + str(pid) + " exited with " + str(status) + ", restarting")
+            pids[spawn_worker(server, slot, metrics_dir)] = slot
+
+    server.server_close()
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def main_serve(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the SuperDoc search API with a prefork worker pool")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes, defaults to the core count")
+    parser.add_argument("--es-url", help="Elasticsearch URL, defaults to SUPERDOC_ES_URL")
+    parser.add_argument("--index", help="index or alias to search, defaults to SUPERDOC_INDEX")
+    parser.add_argument("--documents", help="folder with synonyms.csv and stoplist.txt")
+    args = parser.parse_args(argv)
+
+    es_client.configure(url=args.es_url, index=args.index)
+    if args.documents:
+        os.environ["SUPERDOC_DOCUMENTS"] = args.documents
+
+    serve(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == "__main__":
+    main_serve()
@@ -0,0 +1,47 @@
+import os
+import csv
+import hashlib
+
+HASH_PREFIX = "# sha256: "
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_groups(csv_path):
+    groups = dict()
+    with open(csv_path) as syn_file:
+        for row in csv.reader(syn_file):
+            groups.setdefault(row[0], list()).append(row[1])
+    return groups
+
+
+def compile_synonyms(csv_path, solr_path):
+    # The first line of the Solr file records the hash of the CSV it was
+    # compiled from, so an unchanged CSV costs one hash and no writes.
+    # Returns True when the file was (re)written.
+    digest = file_digest(csv_path)
+    stamp = HASH_PREFIX + digest + "\n"
+
+    if os.path.exists(solr_path):
+        with open(solr_path) as solr_syn_file:
+            if solr_syn_file.readline() == stamp:
+                return False
+
+    with open(solr_path + ".tmp", "w") as solr_syn_file:
+        solr_syn_file.write(stamp)
+        solr_syn_file.writelines(", ".join(words) + "\n" for words in read_groups(csv_path).values())
+    os.replace(solr_path + ".tmp", solr_path)
+    return True
+
+
+def read_terms(csv_path):
+    # Every synonym term, lowercased. Expansion happens in the synonym_graph
+    # filter of the index, the service only needs to know which terms exist.
+    with open(csv_path) as syn_file:
+        return frozenset(row[1].lower() for row in csv.reader(syn_file))
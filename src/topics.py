@@ -0,0 +1,93 @@
+import json
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def text_of(value):
+    if isinstance(value, dict):
+        return value.get("#text")
+    return value
+
+
+def texts_of(value):
+    return [text for text in (text_of(item) for item in as_list(value)) if text]
+
+
+class HealthTopic:
+    # Flattened form of one <health-topic>. The searchable fields are plain
+    # strings and string lists computed once at ingest, instead of the
+    # nested #text/@id dicts xmltodict produces. site and other-language are
+    # kept whole for /document but are not indexed.
+
+    __slots__ = ("id", "title", "url", "meta_desc", "full_summary", "date_created", "language", "also_called",
+                 "see_reference", "mesh_headings", "groups", "related_topics", "primary_institute",
+                 "language_mapped_topic", "site_titles", "site_categories", "sites", "other_languages")
+
+    def __init__(self, element_dict):
+        self.id = element_dict["@id"]
+        self.title = element_dict.get("@title")
+        self.url = element_dict.get("@url")
+        self.meta_desc = element_dict.get("@meta-desc")
+        self.full_summary = element_dict.get("full-summary")
+        self.date_created = element_dict.get("@date-created")
+        self.language = element_dict.get("@language")
+        self.also_called = texts_of(element_dict.get("also-called"))
+        self.see_reference = texts_of(element_dict.get("see-reference"))
+        self.groups = texts_of(element_dict.get("group"))
+        self.related_topics = texts_of(element_dict.get("related-topic"))
+        self.primary_institute = text_of(element_dict.get("primary-institute"))
+        self.language_mapped_topic = text_of(element_dict.get("language-mapped-topic"))
+
+        self.mesh_headings = list()
+        for heading in as_list(element_dict.get("mesh-heading")):
+            self.mesh_headings += texts_of(heading.get("descriptor")) + texts_of(heading.get("qualifier"))
+
+        self.sites = as_list(element_dict.get("site"))
+        self.site_titles = [site["@title"] for site in self.sites if site.get("@title")]
+        self.site_categories = list()
+        for site in self.sites:
+            for category in texts_of(site.get("information-category")):
+                if category not in self.site_categories:
+                    self.site_categories.append(category)
+
+        self.other_languages = as_list(element_dict.get("other-language"))
+
+    def suggest_inputs(self):
+        # Completion inputs for /suggest: the title plus every alternative
+        # name the topic is known by
+        inputs = [self.title]
+        for name in self.also_called + self.see_reference:
+            if name not in inputs:
+                inputs.append(name)
+        return inputs
+
+    def to_source(self):
+        return {
+            "@title": self.title,
+            "@url": self.url,
+            "@meta-desc": self.meta_desc,
+            "@date-created": self.date_created,
+            "@language": self.language,
+            "full-summary": self.full_summary,
+            "also-called": self.also_called,
+            "see-reference": self.see_reference,
+            "mesh-heading": self.mesh_headings,
+            "group": self.groups,
+            "related-topic": self.related_topics,
+            "primary-institute": self.primary_institute,
+            "language-mapped-topic": self.language_mapped_topic,
+            "site-title": self.site_titles,
+            "site-category": self.site_categories,
+            "site": self.sites,
+            "other-language": self.other_languages,
+            "suggest": self.suggest_inputs()
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_source())
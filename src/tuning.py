@@ -0,0 +1,204 @@
+import json
+import argparse
+import statistics
+import es_client
+
+from search_profiles import SEARCH_PAGE_SIZE, SEARCH_PROFILES, build_profile_query, profile_for_kind
+
+RANK_METRIC = {"dcg": {"k": SEARCH_PAGE_SIZE, "normalize": True}}
+DEFAULT_TOLERANCE = 0.01
+DEFAULT_REPEATS = 5
+
+
+def load_judgments(path):
+    # A list of {"q": ..., "ratings": {doc_id: grade}}, with q written the way
+    # it is typed into /search so the kind prefix picks the profile
+    with open(path) as judgments_file:
+        return json.load(judgments_file)
+
+
+def text_fields(properties, prefix=""):
+    fields = list()
+    for name, mapping in sorted(properties.items()):
+        if mapping.get("enabled") in (False, "false"):
+            continue
+        # A query_string naming a field that is not indexed is rejected
+        if mapping.get("type") == "text" and mapping.get("index") not in (False, "false"):
+            fields.append(prefix + name)
+        if "properties" in mapping:
+            fields.extend(text_fields(mapping["properties"], prefix + name + "."))
+    return fields
+
+
+def fetch_text_fields():
+    r = es_client.get(es_client.index_path("/_mapping"))
+    r.raise_for_status()
+    fields = set()
+    for index_mapping in r.json().values():
+        fields.update(text_fields(index_mapping["mappings"].get("properties", dict())))
+    return sorted(fields)
+
+
+def field_name(field):
+    return field.split("^")[0]
+
+
+def candidate_profiles(profile, all_fields, extra_candidates=None):
+    # The profile as it is, its explicitly listed fields alone, and those
+    # plus every other text field at boost 1, which is roughly what "*"
+    # expands to at query time
+    candidates = {"current": profile}
+    explicit = [field for field in profile["fields"] if field != "*"]
+    if len(explicit) < len(profile["fields"]):
+        listed = set(field_name(field) for field in explicit)
+        candidates["explicit"] = dict(profile, fields=explicit)
+        candidates["expanded"] = dict(profile, fields=explicit + [field for field in all_fields if field not in listed])
+
+    for name, fields in (extra_candidates or dict()).items():
+        candidates[name] = dict(profile, fields=fields)
+    return candidates
+
+
+def rank_eval(profile, judged, rated_index):
+    # Ratings are matched on the concrete index of each hit, not the alias
+    requests = [
+        {
+            "id": str(i),
+            "request": {"query": build_profile_query(profile, query)},
+            "ratings": [{"_index": rated_index, "_id": doc_id, "rating": rating} for doc_id, rating in ratings.items()]
+        }
+        for i, (query, ratings) in enumerate(judged)
+    ]
+    r = es_client.post(es_client.index_path("/_rank_eval"), json={"requests": requests, "metric": RANK_METRIC})
+    r.raise_for_status()
+    return r.json()["metric_score"]
+
+
+def query_time_ms(result):
+    # Query and rewrite time from the profile API, summed over shards. This
+    # leaves out fetch and network time, which do not depend on the fields.
+    if "profile" not in result:
+        return float(result["took"])
+
+    nanos = 0
+    for shard in result["profile"]["shards"]:
+        for search in shard["searches"]:
+            nanos += search["rewrite_time"] + sum(query["time_in_nanos"] for query in search["query"])
+    return nanos / 1e6
+
+
+def measure_latency(profile, judged, repeats):
+    per_query = list()
+    for query, _ in judged:
+        payload = {"size": SEARCH_PAGE_SIZE, "profile": True, "query": build_profile_query(profile, query)}
+        samples = list()
+        for _ in range(repeats):
+            r = es_client.post(es_client.index_path("/_search"), json=payload)
+            r.raise_for_status()
+            samples.append(query_time_ms(r.json()))
+        per_query.append(statistics.median(samples))
+
+    per_query.sort()
+    return {
+        "mean_ms": round(statistics.mean(per_query), 3),
+        "max_ms": round(per_query[-1], 3)
+    }
+
+
+def choose_candidate(results, tolerance):
+    # The output never keeps "*": among the candidates without it, the
+    # cheapest one that scores within tolerance of the current profile wins,
+    # otherwise the best scoring one
+    baseline = results["current"]["score"]
+    explicit = [name for name, result in results.items() if "*" not in result["fields"]]
+    eligible = [name for name in explicit if results[name]["score"] >= baseline - tolerance]
+    if eligible:
+        return min(eligible, key=lambda name: results[name]["latency"]["mean_ms"])
+    return max(explicit, key=lambda name: results[name]["score"])
+
+
+def tune_profiles(main, judgments, tolerance=DEFAULT_TOLERANCE, repeats=DEFAULT_REPEATS, extra_candidates=None):
+    # Each judged query goes through the same parsing and analysis as
+    # /search, so the profiles are scored on what they would really receive
+    judged_by_profile = dict()
+    for judgment in judgments:
+        parsed = main.parse_search_query(judgment["q"], None)
+        if parsed is None:
+            continue
+        query_kind, query, _ = parsed
+        judged_by_profile.setdefault(profile_for_kind(query_kind), list()).append((query, judgment["ratings"]))
+
+    all_fields = fetch_text_fields()
+    rated_index = (main.get_alias_indices() or [es_client.INDEX_NAME])[0]
+
+    report = dict()
+    tuned = dict()
+    for profile_name, profile in SEARCH_PROFILES.items():
+        judged = judged_by_profile.get(profile_name)
+        if not judged:
+            # Nothing to score it on, so "*" is spelled out as every text
+            # field rather than kept
+            chosen = "expanded" if "*" in profile["fields"] else "current"
+            print("tune_profiles(): " + profile_name + " has no judged queries, kept " + chosen)
+            tuned[profile_name] = candidate_profiles(profile, all_fields)[chosen]
+            continue
+
+        results = dict()
+        candidates = candidate_profiles(profile, all_fields, (extra_candidates or dict()).get(profile_name))
+        for name, candidate in candidates.items():
+            results[name] = {
+                "fields": candidate["fields"],
+                "score": round(rank_eval(candidate, judged, rated_index), 4),
+                "latency": measure_latency(candidate, judged, repeats)
+            }
+            print("tune_profiles(): " + profile_name + "/" + name + " score=" + str(results[name]["score"]) +
+                  " mean_ms=" + str(results[name]["latency"]["mean_ms"]))
+
+        chosen = choose_candidate(results, tolerance) if len(results) > 1 else "current"
+        tuned[profile_name] = candidates[chosen]
+        report[profile_name] = {"queries": len(judged), "chosen": chosen, "candidates": results}
+
+    return tuned, report
+
+
+def main_tuning(argv=None):
+    parser = argparse.ArgumentParser(description="Score the search profiles against judged queries and write a "
+                                                 "tuned profile config without wildcard fields")
+    parser.add_argument("judgments", help='JSON list of {"q": query, "ratings": {doc_id: grade}}')
+    parser.add_argument("--candidates", help="JSON file mapping profile names to extra named field lists to try")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="nDCG a candidate may lose against the current profile and still be chosen")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS, help="profiled runs per query and candidate")
+    parser.add_argument("--es-url", help="Elasticsearch URL, defaults to SUPERDOC_ES_URL")
+    parser.add_argument("--index", help="index or alias to evaluate, defaults to SUPERDOC_INDEX")
+    parser.add_argument("--output", default="search_profiles.json",
+                        help="where to write the tuned profiles, load them with SUPERDOC_PROFILES_PATH")
+    parser.add_argument("--report", help="write the per-candidate scores and latencies here instead of stdout")
+    args = parser.parse_args(argv)
+
+    es_client.configure(url=args.es_url, index=args.index)
+    import main
+    main.refresh_query_analyzer()
+
+    extra_candidates = None
+    if args.candidates:
+        with open(args.candidates) as candidates_file:
+            extra_candidates = json.load(candidates_file)
+
+    tuned, report = tune_profiles(main, load_judgments(args.judgments), args.tolerance, args.repeats,
+                                  extra_candidates)
+
+    with open(args.output, "w") as output_file:
+        json.dump(tuned, output_file, indent=2)
+        output_file.write("\n")
+
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main_tuning()